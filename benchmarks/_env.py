@@ -0,0 +1,20 @@
+"""Environment shared by the benchmark scripts.
+
+Puts the repository root on sys.path and fills in the settings webapp.py
+reads at import time, so it must be called before webapp is imported.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def configure(database_uri='sqlite:///:memory:', **settings):
+    # setdefault throughout, so a value exported in the shell wins
+    os.environ.setdefault('TESTING', 'True')
+    os.environ.setdefault('SQLALCHEMY_DATABASE_URI', database_uri)
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_BUCKET_NAME', 'bench-bucket')
+    os.environ.setdefault('HOSTNAME', 'localhost')
+    for name, value in settings.items():
+        os.environ.setdefault(name, value)
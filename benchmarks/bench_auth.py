@@ -0,0 +1,73 @@
+"""Cost of the per-request authentication lookup.
+
+Compares loading the full User entity, which is what verify_password did
+before, with the column projection into AuthPrincipal. It reports CPU time
+per lookup and the memory allocated per lookup, measured with tracemalloc.
+Password hashing costs the same on both paths, so it is left out.
+"""
+import timeit
+import tracemalloc
+import uuid
+
+import _env
+
+_env.configure()
+
+from werkzeug.security import generate_password_hash
+
+from webapp import app, db, User, AuthPrincipal, AUTH_COLUMNS
+
+ITERATIONS = 5000
+USERS = 1000
+EMAIL = f"user{USERS // 2}@example.com"
+
+
+def full_entity():
+    user = User.query.filter_by(email=EMAIL).first()
+    db.session.remove()
+    return user
+
+
+def projection():
+    principal = AuthPrincipal(db.session.query(*AUTH_COLUMNS).filter_by(email=EMAIL).first())
+    db.session.remove()
+    return principal
+
+
+def allocated_per_call(func, calls=500):
+    func()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [func() for _ in range(calls)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del results
+    return growth / calls
+
+
+def run(label, func):
+    per_call_us = timeit.timeit(func, number=ITERATIONS) / ITERATIONS * 1e6
+    per_call_bytes = allocated_per_call(func)
+    print(f"{label:<28} {per_call_us:8.2f} us/op {per_call_bytes:10.0f} B retained/op")
+    return per_call_us, per_call_bytes
+
+
+def main():
+    with app.app_context():
+        db.create_all()
+        password_hash = generate_password_hash('password123')
+        db.session.add_all(User(id=str(uuid.uuid4()), first_name="Bench", last_name="User",
+                                email=f"user{i}@example.com", password_hash=password_hash,
+                                is_verified=True) for i in range(USERS))
+        db.session.commit()
+        db.session.remove()
+
+        entity_us, entity_bytes = run("full User entity", full_entity)
+        slim_us, slim_bytes = run("AuthPrincipal projection", projection)
+
+    print(f"{'saved per request':<28} {entity_us - slim_us:8.2f} us    {entity_bytes - slim_bytes:10.0f} B")
+
+
+if __name__ == '__main__':
+    main()
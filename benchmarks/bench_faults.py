@@ -0,0 +1,168 @@
+"""Throughput and tail latency of each route while dependencies misbehave.
+
+Runs every route under a set of fault scenarios, each built from the
+stand-ins in fault_injection.py: slow or throttled S3, an S3 outage, slow
+SNS and a slow database. Each scenario is driven by concurrent threads, and
+the benchmark prints requests/s, p50, p99 and the status codes seen per
+route. Passwords are hashed with a cheap pbkdf2 setting so that dependency
+time, not hashing, dominates the numbers. Pass scenario names to run only
+those:
+
+    python benchmarks/bench_faults.py slow_s3 s3_outage
+"""
+import base64
+import io
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+from functools import partial
+from unittest.mock import patch
+
+import _env
+
+WORKDIR = tempfile.mkdtemp(prefix='bench-faults-')
+
+_env.configure(f"sqlite:///{os.path.join(WORKDIR, 'webapp.db')}", SLOW_QUERY_THRESHOLD_MS='60000')
+
+from werkzeug.security import generate_password_hash
+
+from webapp import app, db, User, S3Storage, breakers
+from fault_injection import FaultProfile, FaultyS3Client, FaultySNSClient, inject_db_faults
+
+THREADS = 8
+REQUESTS_PER_THREAD = 20
+PASSWORD = 'password123'
+PNG_BYTES = b'\x89PNG\r\n\x1a\n' + b'\x00' * 1024
+
+fast_password_hash = partial(generate_password_hash, method='pbkdf2:sha256:1000')
+
+
+def aws_timeout_ms():
+    return app.config['AWS_READ_TIMEOUT_SECONDS'] * 1000
+
+
+SCENARIOS = {
+    'baseline': lambda: {},
+    'slow_s3': lambda: {'s3': FaultProfile(median_ms=80, p99_ms=1500, timeout_ms=aws_timeout_ms())},
+    's3_throttled': lambda: {'s3': FaultProfile(median_ms=20, p99_ms=200, throttle_rate=0.5)},
+    's3_outage': lambda: {'s3': FaultProfile(median_ms=20, p99_ms=200, error_rate=1.0)},
+    'slow_sns': lambda: {'sns': FaultProfile(median_ms=200, p99_ms=6000, timeout_ms=aws_timeout_ms())},
+    'slow_db': lambda: {'db': FaultProfile(median_ms=5, p99_ms=50)},
+}
+
+
+def auth_header(email):
+    return {'Authorization': 'Basic ' + base64.b64encode(f"{email}:{PASSWORD}".encode()).decode()}
+
+
+def user_email(worker, i):
+    return f"bench{worker}-{i}@example.com"
+
+
+def create_users():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        password_hash = fast_password_hash(PASSWORD)
+        db.session.add_all(User(id=str(uuid.uuid4()), first_name="Bench", last_name="User",
+                                email=user_email(worker, i), password_hash=password_hash, is_verified=True)
+                           for worker in range(THREADS) for i in range(REQUESTS_PER_THREAD))
+        db.session.commit()
+        db.session.remove()
+
+
+def signup(client, worker, i):
+    return client.post('/v1/user', json={"first_name": "New", "last_name": "User",
+                                         "email": f"new{worker}-{i}@example.com", "password": PASSWORD})
+
+
+def get_user(client, worker, i):
+    return client.get('/v1/user/self', headers=auth_header(user_email(worker, i)))
+
+
+def upload_pic(client, worker, i):
+    return client.post('/v1/user/self/pic', headers=auth_header(user_email(worker, i)),
+                       data={'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}, content_type='multipart/form-data')
+
+
+def download_pic(client, worker, i):
+    return client.get('/v1/user/self/pic/file', headers=auth_header(user_email(worker, i)))
+
+
+ROUTES = (
+    ('POST /v1/user', signup),
+    ('GET /v1/user/self', get_user),
+    ('POST /v1/user/self/pic', upload_pic),
+    ('GET /v1/user/self/pic/file', download_pic),
+)
+
+
+def drive(route):
+    latencies, statuses = [], Counter()
+    lock = threading.Lock()
+
+    def worker(n):
+        client = app.test_client()
+        for i in range(REQUESTS_PER_THREAD):
+            started = time.perf_counter()
+            status = route(client, n, i).status_code
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies) / (time.perf_counter() - started), latencies, statuses
+
+
+def run_scenario(name):
+    faults = SCENARIOS[name]()
+    create_users()
+    for breaker in breakers.values():
+        breaker.reset()
+
+    s3 = FaultyS3Client(faults.get('s3'))
+    sns = FaultySNSClient(faults.get('sns'))
+    with ExitStack() as stack:
+        stack.enter_context(patch('webapp.storage', S3Storage(s3, 'bench-bucket')))
+        stack.enter_context(patch('webapp.sns_client', sns))
+        stack.enter_context(patch('webapp.SNS_TOPIC_ARN', 'bench-topic'))
+        stack.enter_context(patch('webapp.TESTING', False))
+        stack.enter_context(patch('webapp.generate_password_hash', fast_password_hash))
+        if 'db' in faults:
+            with app.app_context():
+                stack.enter_context(inject_db_faults(db.engine, faults['db']))
+
+        print(f"\n== {name}")
+        for label, route in ROUTES:
+            rate, latencies, statuses = drive(route)
+            p50 = statistics.median(latencies) * 1000
+            p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+            codes = ' '.join(f"{code}x{count}" for code, count in sorted(statuses.items()))
+            print(f"{label:<28} {rate:8.1f} req/s  p50 {p50:8.1f} ms  p99 {p99:8.1f} ms  {codes}")
+
+
+def main():
+    # Injected failures are expected here; keep their log lines out of the report
+    logging.disable(logging.ERROR)
+    print(f"{THREADS} threads x {REQUESTS_PER_THREAD} requests per route")
+    for name in sys.argv[1:] or SCENARIOS:
+        run_scenario(name)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
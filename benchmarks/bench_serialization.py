@@ -0,0 +1,84 @@
+"""Microbenchmarks for request validation and JSON response serialization.
+
+Compares the hand-rolled validation and stdlib-backed jsonify that the
+handlers used before the schema layer against validate_payload and the
+orjson JSON provider.
+"""
+import re
+import timeit
+import uuid
+from datetime import datetime
+
+import _env
+
+_env.configure()
+
+from flask.json.provider import DefaultJSONProvider
+
+from webapp import app, User, validate_payload, serialize_user, USER_CREATE_SCHEMA
+
+ITERATIONS = 20000
+
+PAYLOAD = {
+    "first_name": "John",
+    "last_name": "Doe",
+    "email": "john.doe@example.com",
+    "password": "password123"
+}
+
+USER = User(
+    id=str(uuid.uuid4()),
+    first_name="John",
+    last_name="Doe",
+    email="john.doe@example.com",
+    account_created=datetime.utcnow(),
+    account_updated=datetime.utcnow()
+)
+
+
+def legacy_validate(data):
+    required_keys = ('first_name', 'last_name', 'email', 'password')
+    if not all(key in data for key in required_keys):
+        return False
+    if not data['first_name'].isalpha() or not data['last_name'].isalpha():
+        return False
+    if re.match(r'^[\w\.-]+@[\w\.-]+\.\w+$', data['email']) is None:
+        return False
+    return len(data['password']) >= 8
+
+
+def legacy_response(provider):
+    return provider.response({
+        "id": USER.id,
+        "first_name": USER.first_name,
+        "last_name": USER.last_name,
+        "email": USER.email,
+        "account_created": USER.account_created.isoformat(),
+        "account_updated": USER.account_updated.isoformat()
+    })
+
+
+def run(label, func):
+    per_call_us = timeit.timeit(func, number=ITERATIONS) / ITERATIONS * 1e6
+    print(f"{label:<40} {per_call_us:8.2f} us/op")
+    return per_call_us
+
+
+def main():
+    default_provider = DefaultJSONProvider(app)
+    current_provider = app.json
+
+    with app.app_context():
+        print(f"JSON provider: {type(current_provider).__name__}")
+        legacy_validation = run("validation (legacy)", lambda: legacy_validate(PAYLOAD))
+        schema_validation = run("validation (schema)", lambda: validate_payload(PAYLOAD, USER_CREATE_SCHEMA))
+        legacy_json = run("user response (dict + stdlib json)", lambda: legacy_response(default_provider))
+        current_json = run("user response (serializer + provider)",
+                           lambda: current_provider.response(serialize_user(USER)))
+
+    saved = (legacy_validation + legacy_json) - (schema_validation + current_json)
+    print(f"{'per-request CPU saved':<40} {saved:8.2f} us")
+
+
+if __name__ == '__main__':
+    main()
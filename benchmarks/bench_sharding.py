@@ -0,0 +1,82 @@
+"""Signup throughput as the number of shards grows.
+
+Each shard is a separate SQLite file, so writers on different shards do not
+contend for the same database lock. Worker threads sign users up through
+POST /v1/user and the benchmark reports signups per second for 1, 2 and 4
+shards. With more than one shard it also runs with a rebalance from one
+shard pending, where every signup first checks the email's old shard.
+Passwords are hashed with a cheap pbkdf2 setting so the numbers reflect the
+database.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from unittest.mock import patch
+
+import _env
+
+WORKDIR = tempfile.mkdtemp(prefix='bench-shards-')
+
+_env.configure(f"sqlite:///{os.path.join(WORKDIR, 'shard0.db')}", SLOW_QUERY_THRESHOLD_MS='60000')
+
+from werkzeug.security import generate_password_hash
+
+from webapp import app, db, shard_router, create_shard_tables
+
+THREADS = 8
+USERS_PER_THREAD = 200
+SHARD_COUNTS = (1, 2, 4)
+
+fast_password_hash = partial(generate_password_hash, method='pbkdf2:sha256:1000')
+
+
+def configure_shards(count, previous_count):
+    shard_router.configure([f"sqlite:///{os.path.join(WORKDIR, f'shard{i}-of-{count}-from-{previous_count}.db')}"
+                            for i in range(1, count)], previous_count)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        create_shard_tables()
+
+
+def signup_users(worker):
+    client = app.test_client()
+    for i in range(USERS_PER_THREAD):
+        response = client.post('/v1/user', json={"first_name": "Bench", "last_name": "User",
+                                                 "email": f"user{worker}-{i}@example.com", "password": "password123"})
+        assert response.status_code == 201, response.status_code
+
+
+def run(count, previous_count=0):
+    configure_shards(count, previous_count)
+    threads = [threading.Thread(target=signup_users, args=(worker,)) for worker in range(THREADS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    rate = THREADS * USERS_PER_THREAD / elapsed
+    label = f"{count} shard(s)" + (f", rebalance from {previous_count} pending" if previous_count else "")
+    print(f"{label:<40} {rate:10.0f} signups/s")
+    return rate
+
+
+def main():
+    # One access log line per signup would drown the report
+    logging.disable(logging.WARNING)
+    print(f"{THREADS} threads x {USERS_PER_THREAD} signups, databases in {WORKDIR}")
+    with patch('webapp.generate_password_hash', fast_password_hash):
+        baseline = run(SHARD_COUNTS[0])
+        for count in SHARD_COUNTS[1:]:
+            print(f"{'':41}{run(count) / baseline:.2f}x vs 1 shard")
+            print(f"{'':41}{run(count, previous_count=1) / baseline:.2f}x vs 1 shard")
+    shard_router.configure([])
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Local stand-ins for S3, SNS and the database that inject latency, errors and throttling.
+
+Used by the integration tests and benchmarks/bench_faults.py to see how the
+routes behave when a dependency is slow or failing, instead of the instant
+MagicMocks in conftest.py.
+"""
+import math
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+from sqlalchemy import event, exc
+
+
+class FaultProfile:
+    # Latency is log-normal with the given median and p99, the shape network calls usually have
+    def __init__(self, median_ms=0.0, p99_ms=None, error_rate=0.0, throttle_rate=0.0, timeout_ms=None, seed=None):
+        self.median_ms = median_ms
+        self.sigma = math.log(p99_ms / median_ms) / 2.326 if median_ms and p99_ms else 0.0
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.timeout_ms = timeout_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def sample(self):
+        with self.lock:
+            self.calls += 1
+            latency_ms = self.random.lognormvariate(math.log(self.median_ms), self.sigma) if self.median_ms else 0.0
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return latency_ms, 'throttle'
+        if roll < self.throttle_rate + self.error_rate:
+            return latency_ms, 'error'
+        return latency_ms, None
+
+    def apply(self, operation):
+        latency_ms, fault = self.sample()
+        if self.timeout_ms is not None and latency_ms > self.timeout_ms:
+            # What botocore does once read_timeout passes
+            time.sleep(self.timeout_ms / 1000)
+            raise ReadTimeoutError(endpoint_url=f"https://fault-injection/{operation}")
+        time.sleep(latency_ms / 1000)
+        if fault == 'throttle':
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Injected throttle'},
+                               'ResponseMetadata': {'HTTPStatusCode': 503}}, operation)
+        if fault == 'error':
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'Injected error'},
+                               'ResponseMetadata': {'HTTPStatusCode': 500}}, operation)
+
+
+class FaultyS3Client:
+    def __init__(self, profile=None):
+        self.profile = profile or FaultProfile()
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        self.profile.apply('PutObject')
+        self.objects[key] = fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self.profile.apply('DeleteObject')
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self.profile.apply('DeleteObjects')
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+        return {}
+
+    def get_paginator(self, operation):
+        return FaultyPaginator(self)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        # Signing happens locally in botocore, so it gets no injected latency
+        return f"https://{Params['Bucket']}.s3.fault-injection/{Params['Key']}?expires={ExpiresIn}"
+
+
+class FaultyPaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        keys = sorted(key for key in self.client.objects if key.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), page_size):
+            self.client.profile.apply('ListObjectsV2')
+            yield {'Contents': [{'Key': key} for key in keys[start:start + page_size]]}
+
+
+class FaultySNSClient:
+    def __init__(self, profile=None):
+        self.profile = profile or FaultProfile()
+        self.published = []
+
+    def publish(self, TopicArn, Message):
+        self.profile.apply('Publish')
+        self.published.append((TopicArn, Message))
+        return {'MessageId': str(uuid.uuid4())}
+
+
+@contextmanager
+def inject_db_faults(engine, profile):
+    # Every statement on the engine waits the sampled latency; errors surface as OperationalError
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        latency_ms, fault = profile.sample()
+        time.sleep(latency_ms / 1000)
+        if fault is not None:
+            raise exc.OperationalError(statement, parameters, Exception(f"Injected database {fault}"))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield profile
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
@@ -1,4 +1,6 @@
 import base64
+import hashlib
+import io
 import os
 import pytest
 from unittest.mock import patch, MagicMock
@@ -7,6 +9,7 @@ from datetime import datetime, timezone, timedelta
 import uuid
 import boto3
 from flask_migrate import Migrate
+from botocore.exceptions import ClientError
 
 # Set test environment variables
 os.environ['TESTING'] = 'True'
@@ -48,6 +51,14 @@ def stop_patches():
     for p in patches:
         p.stop()
 
+@pytest.fixture(autouse=True)
+def empty_storage():
+    # The in-memory backend lives at module level; each test starts without earlier tests' objects
+    from webapp import storage
+    storage.objects.clear()
+    yield storage
+    storage.objects.clear()
+
 @pytest.fixture
 def client():
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
@@ -264,5 +275,944 @@ def test_create_user_invalid_data(client):
                              content_type='application/json')
         assert response.status_code == 400
 
+def test_request_query_count_header(client, create_test_user):
+    with client.application.app_context():
+        user = db.session.get(User, create_test_user)
+        user.is_verified = True
+        db.session.commit()
+
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    response = client.get('/v1/user/self', headers={'Authorization': f'Basic {auth_str}'})
+
+    assert response.status_code == 200
+    server_timing = response.headers['Server-Timing']
+    assert server_timing.startswith('total;dur=')
+    assert 'db;dur=' in server_timing
+    assert 'desc="1 queries"' in server_timing
+    for phase in ('auth', 'hash', 'serialize'):
+        assert f'{phase};dur=' in server_timing
+
+def test_slow_query_logged_with_route(client, caplog):
+    client.application.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+    try:
+        response = client.get('/healthz')
+    finally:
+        client.application.config['SLOW_QUERY_THRESHOLD_MS'] = 100
+
+    assert response.status_code == 200
+    assert any('Slow query' in r.message and '/healthz' in r.message for r in caplog.records)
+
+
+def test_structured_access_log(client, caplog):
+    caplog.set_level('INFO', logger='webapp')
+    client.get('/healthz')
+
+    access_lines = [json.loads(r.message) for r in caplog.records if r.message.startswith('{')]
+    assert len(access_lines) == 1
+    assert access_lines[0]['path'] == '/healthz'
+    assert access_lines[0]['status'] == 200
+    assert 'db' in access_lines[0]['phases_ms']
+
+
+def test_picture_routes_use_single_query(client, create_test_user):
+    from webapp import Image
+    with client.application.app_context():
+        user = db.session.get(User, create_test_user)
+        user.is_verified = True
+        db.session.add(Image(
+            id=str(uuid.uuid4()),
+            file_name='profile.png',
+            url=f'test-bucket/{create_test_user}/profile.png',
+            user_id=create_test_user
+        ))
+        db.session.commit()
+
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    headers = {'Authorization': f'Basic {auth_str}'}
+
+    response = client.get('/v1/user/self/pic', headers=headers)
+    assert response.status_code == 200
+    assert response.json['file_name'] == 'profile.png'
+    assert 'desc="1 queries"' in response.headers['Server-Timing']
+
+    # One SELECT for user and image, one DELETE
+    response = client.delete('/v1/user/self/pic', headers=headers)
+    assert response.status_code == 204
+    assert 'desc="2 queries"' in response.headers['Server-Timing']
+
+
+def test_verify_user_with_hashed_token(client, mock_aws):
+    with patch('webapp.sns_client', new=mock_aws['sns']), \
+         patch('webapp.SNS_TOPIC_ARN', new='test-topic-arn'), \
+         patch('webapp.TESTING', new=False):
+        response = client.post('/v1/user', json={
+            "first_name": "John",
+            "last_name": "Doe",
+            "email": "john@example.com",
+            "password": "password123"
+        })
+    assert response.status_code == 201
+
+    token = json.loads(mock_aws['sns'].publish.call_args[1]['Message'])['token']
+    with client.application.app_context():
+        user = User.query.filter_by(email="john@example.com").first()
+        assert user.verification_token != token
+        assert len(user.verification_token) == 64
+
+    assert client.get('/v1/user/verify?token=wrong').status_code == 400
+    assert client.get(f'/v1/user/verify?token={token}').status_code == 200
+    with client.application.app_context():
+        assert User.query.filter_by(email="john@example.com").first().is_verified
+
+def test_verify_accepts_unexpired_legacy_token(client):
+    with client.application.app_context():
+        legacy = make_verified_user("legacy@example.com")
+        legacy.is_verified = False
+        legacy.verification_token = legacy.id + "s3cret"
+        legacy.token_expiry = datetime.utcnow() + timedelta(minutes=2)
+        hashed = make_verified_user("hashed@example.com")
+        hashed.is_verified = False
+        hashed.verification_token = hashlib.sha256(b"random").hexdigest()
+        hashed.token_expiry = datetime.utcnow() + timedelta(minutes=2)
+        db.session.commit()
+        legacy_id, hashed_id = legacy.id, hashed.id
+
+    with patch.dict(client.application.config, {'SECRET_TOKEN': "s3cret"}):
+        # A user_id + SECRET_TOKEN link only matches rows that still store the legacy value
+        assert client.get(f'/v1/user/verify?token={hashed_id}s3cret').status_code == 400
+        assert client.get(f'/v1/user/verify?token={legacy_id}s3cret').status_code == 200
+    with client.application.app_context():
+        assert db.session.get(User, legacy_id).is_verified
+
+def test_reap_expired_users(client):
+    from webapp import reap_expired_users
+    expired = datetime.utcnow() - timedelta(minutes=5)
+    with client.application.app_context():
+        for i in range(5):
+            db.session.add(User(id=str(uuid.uuid4()), first_name="Old", last_name="User",
+                                email=f"old{i}@example.com", token_expiry=expired, is_verified=False))
+        db.session.add(User(id=str(uuid.uuid4()), first_name="New", last_name="User",
+                            email="new@example.com", is_verified=False,
+                            token_expiry=datetime.utcnow() + timedelta(minutes=2)))
+        db.session.add(User(id=str(uuid.uuid4()), first_name="Done", last_name="User",
+                            email="done@example.com", token_expiry=expired, is_verified=True))
+        db.session.commit()
+
+        assert reap_expired_users(batch_size=2, max_batches=10) == 5
+        remaining = {u.email for u in User.query.all()}
+        assert remaining == {"new@example.com", "done@example.com"}
+
+
+@pytest.fixture
+def replicas(client, tmp_path):
+    from webapp import replica_pool, recent_writers
+    from sqlalchemy import create_engine
+    uris = [f"sqlite:///{tmp_path / f'replica{i}.db'}" for i in range(2)]
+    for uri in uris:
+        engine = create_engine(uri)
+        db.metadata.create_all(engine)
+        engine.dispose()
+    replica_pool.configure(uris)
+    yield replica_pool
+    replica_pool.configure([])
+    recent_writers.clear()
+
+def test_recent_writers_are_swept_after_the_window(client, replicas):
+    from webapp import mark_recent_write, recent_writers, wrote_recently
+    with patch.dict(client.application.config, {'READ_YOUR_WRITES_SECONDS': 0}):
+        for i in range(100):
+            mark_recent_write(f"writer{i}@example.com")
+    mark_recent_write("reader@example.com")
+    assert list(recent_writers) == ["reader@example.com"]
+    assert wrote_recently("reader@example.com")
+    assert not wrote_recently("writer0@example.com")
+
+def add_verified_user(bind, first_name):
+    from sqlalchemy.orm import Session
+    with Session(bind) as session:
+        user = User(id="11111111-1111-1111-1111-111111111111", first_name=first_name,
+                    last_name="Doe", email="john@example.com", is_verified=True)
+        user.set_password('password123')
+        session.add(user)
+        session.commit()
+
+def test_replica_round_robin_and_ejection(replicas):
+    first, second = replicas.engines
+    assert [replicas.pick(), replicas.pick(), replicas.pick()] == [first, second, first]
+
+    replicas.eject(second)
+    assert {replicas.pick() for _ in range(4)} == {first}
+
+    assert replicas.probe() == 2
+    assert {replicas.pick() for _ in range(4)} == {first, second}
+
+def test_reads_use_replica_and_writes_use_primary(client, replicas):
+    with client.application.app_context():
+        add_verified_user(db.engine, "Primary")
+    for engine in replicas.engines:
+        add_verified_user(engine, "Replica")
+
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    headers = {'Authorization': f'Basic {auth_str}'}
+
+    response = client.get('/v1/user/self', headers=headers)
+    assert response.json['first_name'] == "Replica"
+
+    response = client.put('/v1/user/self', headers=headers, json={
+        "first_name": "Updated",
+        "last_name": "Doe",
+        "password": "password123"
+    })
+    assert response.status_code == 200
+
+    # Read-your-writes: the follow-up read goes to the primary
+    response = client.get('/v1/user/self', headers=headers)
+    assert response.json['first_name'] == "Updated"
+    for engine in replicas.engines:
+        with engine.connect() as conn:
+            assert conn.execute(db.text("SELECT first_name FROM user")).scalar() == "Replica"
+
+
+@pytest.fixture
+def admin_headers(client):
+    client.application.config['ADMIN_API_TOKEN'] = 'admin-secret'
+    yield {'Authorization': 'Bearer admin-secret'}
+    client.application.config['ADMIN_API_TOKEN'] = None
+
+def add_users(count):
+    created = datetime(2024, 1, 1)
+    for i in range(count):
+        # Pairs of users share a timestamp so the id tie-breaker is exercised
+        db.session.add(User(id=str(uuid.uuid4()), first_name="User", last_name="Doe",
+                            email=f"user{i}@example.com", account_created=created + timedelta(seconds=i // 2)))
+    db.session.commit()
+
+def test_admin_list_users_keyset_pagination(client, admin_headers):
+    with client.application.app_context():
+        add_users(5)
+
+    assert client.get('/v1/admin/users').status_code == 401
+    assert client.get('/v1/admin/users', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/v1/admin/users?cursor=bogus', headers=admin_headers).status_code == 400
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/v1/admin/users?limit=2' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url, headers=admin_headers)
+        assert response.status_code == 200
+        seen.extend(user['email'] for user in response.json['users'])
+        cursor = response.json['next_cursor']
+        if not cursor:
+            break
+
+    assert len(seen) == 5
+    assert set(seen) == {f"user{i}@example.com" for i in range(5)}
+
+def test_admin_export_streams_ndjson_and_csv(client, admin_headers):
+    with client.application.app_context():
+        add_users(3)
+
+    response = client.get('/v1/admin/users/export', headers=admin_headers)
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(rows) == 3
+    assert 'password_hash' not in rows[0]
+
+    response = client.get('/v1/admin/users/export?format=csv', headers=admin_headers)
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == 'id,first_name,last_name,email,is_verified,account_created,account_updated'
+    assert len(lines) == 4
+
+    assert client.get('/v1/admin/users/export?format=xml', headers=admin_headers).status_code == 400
+
+
+def test_delete_user_enqueues_storage_cleanup(client, create_test_user):
+    from webapp import Image, StorageCleanupTask
+    with client.application.app_context():
+        user = db.session.get(User, create_test_user)
+        user.is_verified = True
+        db.session.add(Image(id=str(uuid.uuid4()), file_name='profile.png',
+                             url=f'test-bucket/{create_test_user}/profile.png', user_id=create_test_user))
+        db.session.commit()
+
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    response = client.delete('/v1/user/self', headers={'Authorization': f'Basic {auth_str}'})
+    assert response.status_code == 204
+
+    with client.application.app_context():
+        assert db.session.get(User, create_test_user) is None
+        assert Image.query.count() == 0
+        assert [task.prefix for task in StorageCleanupTask.query.all()] == [f"{create_test_user}/"]
+
+def test_s3_storage_deletes_prefix_in_batches():
+    from webapp import S3Storage
+    s3 = MagicMock()
+    pages = [{'Contents': [{'Key': f'u1/{i}'} for i in range(1000)]}, {'Contents': [{'Key': 'u1/last'}]}]
+    s3.get_paginator.return_value.paginate.return_value = pages
+    s3.delete_objects.return_value = {}
+
+    assert S3Storage(s3, 'test-bucket').delete_prefix('u1/') == 1001
+    assert [len(c.kwargs['Delete']['Objects']) for c in s3.delete_objects.call_args_list] == [1000, 1]
+
+def test_storage_cleanup_retries(client):
+    from webapp import StorageCleanupTask, process_storage_cleanup, storage
+    storage.objects['u1/profile.png'] = (b'png', 'image/png')
+    with client.application.app_context():
+        db.session.add(StorageCleanupTask(id=str(uuid.uuid4()), prefix='u1/'))
+        db.session.commit()
+
+        with patch.object(storage, 'delete_prefix', side_effect=ClientError({'Error': {'Code': 'SlowDown'}}, 'DeleteObjects')):
+            assert process_storage_cleanup() == 0
+        task = StorageCleanupTask.query.one()
+        assert task.attempts == 1
+        assert task.next_attempt_at > datetime.utcnow()
+
+        task.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        assert process_storage_cleanup() == 1
+        assert StorageCleanupTask.query.count() == 0
+        assert 'u1/profile.png' not in storage.objects
+
+PNG_BYTES = b'\x89PNG\r\n\x1a\n' + b'0123456789'
+
+def upload_and_download(client, headers):
+    data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+    response = client.post('/v1/user/self/pic', headers=headers, data=data, content_type='multipart/form-data')
+    assert response.status_code == 201
+
+    response = client.get('/v1/user/self/pic/file', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.get_data() == PNG_BYTES
+
+    response = client.get('/v1/user/self/pic/file', headers={**headers, 'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.get_data() == PNG_BYTES[2:6]
+
+def test_memory_storage_upload_and_range_download(client, create_test_user):
+    with client.application.app_context():
+        db.session.get(User, create_test_user).is_verified = True
+        db.session.commit()
+
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    upload_and_download(client, {'Authorization': f'Basic {auth_str}'})
+
+def test_local_storage_upload_and_range_download(client, create_test_user, tmp_path):
+    from webapp import LocalFileStorage
+    with client.application.app_context():
+        db.session.get(User, create_test_user).is_verified = True
+        db.session.commit()
+
+    local = LocalFileStorage(str(tmp_path))
+    auth_str = base64.b64encode(b"john@example.com:password123").decode()
+    with patch('webapp.storage', new=local):
+        upload_and_download(client, {'Authorization': f'Basic {auth_str}'})
+    content_hash = hashlib.sha256(PNG_BYTES).hexdigest()
+    assert (tmp_path / 'blobs' / content_hash).read_bytes() == PNG_BYTES
+    assert local.delete_prefix(f'blobs/{content_hash}') == 1
+
+    for key in ('u1/profile.png', 'u1/thumbs/small.png', 'u10/profile.png'):
+        local.put(key, io.BytesIO(PNG_BYTES), 'image/png')
+    assert local.delete_prefix('u1/') == 2
+    assert local.delete_prefix('u1/') == 0
+    assert (tmp_path / 'u10' / 'profile.png').exists()
+
+def make_verified_user(email):
+    user = User(id=str(uuid.uuid4()), first_name="Pic", last_name="User", email=email, is_verified=True)
+    user.set_password('password123')
+    db.session.add(user)
+    return user
+
+def basic_auth(email):
+    return {'Authorization': 'Basic ' + base64.b64encode(f"{email}:password123".encode()).decode()}
+
+def test_upload_rejects_non_image_content(client):
+    from webapp import storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+
+    with patch.object(storage, 'put') as put:
+        data = {'profilePic': (io.BytesIO(b'<?php echo 1; ?>'), 'shell.png')}
+        response = client.post('/v1/user/self/pic', headers=basic_auth("a@example.com"),
+                               data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    put.assert_not_called()
+
+def test_duplicate_uploads_share_one_blob(client):
+    from webapp import StorageCleanupTask, process_storage_cleanup, storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        make_verified_user("b@example.com")
+        db.session.commit()
+
+    with patch.object(storage, 'put', wraps=storage.put) as put:
+        for email in ("a@example.com", "b@example.com"):
+            data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+            response = client.post('/v1/user/self/pic', headers=basic_auth(email),
+                                   data=data, content_type='multipart/form-data')
+            assert response.status_code == 201
+    assert put.call_count == 1
+
+    key = f"blobs/{hashlib.sha256(PNG_BYTES).hexdigest()}"
+    with patch.dict(client.application.config, {'BLOB_CLEANUP_GRACE_SECONDS': 0}):
+        assert client.delete('/v1/user/self/pic', headers=basic_auth("a@example.com")).status_code == 204
+        process_storage_cleanup()
+        assert key in storage.objects
+
+        assert client.delete('/v1/user/self/pic', headers=basic_auth("b@example.com")).status_code == 204
+        process_storage_cleanup()
+    assert key not in storage.objects
+    assert StorageCleanupTask.query.count() == 0
+
+
+def test_idempotent_create_user_replays_first_response(client, mock_aws):
+    data = {"first_name": "John", "last_name": "Doe", "email": "john@example.com", "password": "password123"}
+    headers = {'Idempotency-Key': 'signup-1'}
+    with patch('webapp.sns_client', new=mock_aws['sns']), \
+         patch('webapp.SNS_TOPIC_ARN', new='test-topic-arn'), \
+         patch('webapp.TESTING', new=False):
+        first = client.post('/v1/user', json=data, headers=headers)
+        second = client.post('/v1/user', json=data, headers=headers)
+
+    assert first.status_code == second.status_code == 201
+    assert second.json == first.json
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    mock_aws['sns'].publish.assert_called_once()
+
+    # Same key with a different body is rejected
+    response = client.post('/v1/user', json={**data, "first_name": "Jane"}, headers=headers)
+    assert response.status_code == 422
+
+def test_idempotent_request_waits_for_in_flight_duplicate(client):
+    from webapp import IdempotencyRecord, reap_idempotency_records
+    data = {"first_name": "John", "last_name": "Doe", "email": "john@example.com", "password": "password123"}
+    key = hashlib.sha256(b"create_user::signup-2").hexdigest()
+    with client.application.test_request_context('/v1/user', method='POST', json=data):
+        from webapp import request_fingerprint
+        fingerprint = request_fingerprint()
+    db.session.add(IdempotencyRecord(key=key, request_hash=fingerprint,
+                                     expires_at=datetime.utcnow() + timedelta(hours=1)))
+    db.session.commit()
+
+    def finish_first_request(seconds):
+        record = db.session.get(IdempotencyRecord, key)
+        record.status_code = 201
+        record.content_type = 'application/json'
+        record.response_body = b'{"id": "first"}'
+        db.session.commit()
+
+    with patch('webapp.time.sleep', side_effect=finish_first_request) as sleep:
+        response = client.post('/v1/user', json=data, headers={'Idempotency-Key': 'signup-2'})
+    assert sleep.called
+    assert response.status_code == 201
+    assert response.json == {"id": "first"}
+    assert User.query.count() == 0
+
+    db.session.get(IdempotencyRecord, key).expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert reap_idempotency_records() == 1
+
+
+@pytest.fixture
+def breakers(client):
+    from webapp import breakers
+    for breaker in breakers.values():
+        breaker.reset()
+    yield breakers
+    for breaker in breakers.values():
+        breaker.reset()
+
+def test_circuit_breaker_opens_and_recovers(client, breakers):
+    from webapp import CircuitOpenError
+    breaker = breakers['s3']
+    failing = MagicMock(side_effect=ClientError(
+        {'Error': {'Code': 'InternalError'}, 'ResponseMetadata': {'HTTPStatusCode': 500}}, 'PutObject'))
+
+    for _ in range(client.application.config['BREAKER_MIN_CALLS']):
+        with pytest.raises(ClientError):
+            breaker.call(failing)
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        breaker.call(MagicMock())
+
+    # After the open period a single probe is let through; its success closes the breaker
+    breaker.opened_at -= client.application.config['BREAKER_OPEN_SECONDS']
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == 'closed'
+
+def test_upload_fails_fast_when_s3_breaker_open(client, breakers):
+    from webapp import S3Storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+
+    s3 = MagicMock()
+    breakers['s3'].transition('open')
+    with patch('webapp.storage', new=S3Storage(s3, 'test-bucket')):
+        data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+        response = client.post('/v1/user/self/pic', headers=basic_auth("a@example.com"),
+                               data=data, content_type='multipart/form-data')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) > 0
+    s3.upload_fileobj.assert_not_called()
+
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.json['dependencies']['s3']['state'] == 'open'
+
+def test_sns_publish_deferred_when_breaker_open(client, mock_aws, breakers):
+    from webapp import PendingNotification, process_pending_notifications
+    breakers['sns'].transition('open')
+    with patch('webapp.sns_client', new=mock_aws['sns']), \
+         patch('webapp.SNS_TOPIC_ARN', new='test-topic-arn'), \
+         patch('webapp.TESTING', new=False):
+        response = client.post('/v1/user', json={
+            "first_name": "John", "last_name": "Doe", "email": "john@example.com", "password": "password123"
+        })
+        assert response.status_code == 201
+        mock_aws['sns'].publish.assert_not_called()
+        assert PendingNotification.query.count() == 1
+
+        assert process_pending_notifications() == 0
+        breakers['sns'].reset()
+        assert process_pending_notifications() == 1
+
+    mock_aws['sns'].publish.assert_called_once()
+    message = json.loads(mock_aws['sns'].publish.call_args[1]['Message'])
+    assert message['email'] == "john@example.com"
+    assert PendingNotification.query.count() == 0
+    # The token is minted at delivery, so the link is valid for a full TTL from then
+    assert client.get(f"/v1/user/verify?token={message['token']}").status_code == 200
+
+def test_deferred_notification_dropped_for_missing_or_verified_user(client, mock_aws):
+    from webapp import PendingNotification, process_pending_notifications
+    with client.application.app_context():
+        verified = make_verified_user("a@example.com")
+        db.session.add(PendingNotification(id=str(uuid.uuid4()), topic_arn='test-topic-arn', user_id=verified.id))
+        db.session.add(PendingNotification(id=str(uuid.uuid4()), topic_arn='test-topic-arn', user_id=str(uuid.uuid4())))
+        db.session.commit()
+
+    with patch('webapp.sns_client', new=mock_aws['sns']):
+        assert process_pending_notifications() == 0
+    mock_aws['sns'].publish.assert_not_called()
+    assert PendingNotification.query.count() == 0
+
+
+@pytest.fixture
+def degraded_cache(client):
+    from webapp import user_cache
+    user_cache.entries.clear()
+    with patch.dict(client.application.config, {'DEGRADED_CACHE_ENABLED': True}):
+        yield user_cache
+    user_cache.entries.clear()
+
+def test_degraded_mode_serves_cached_reads(client, degraded_cache):
+    from webapp import degraded_mode
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+
+    headers = basic_auth("a@example.com")
+    assert client.get('/v1/user/self', headers=headers).status_code == 200
+
+    failing_execute = MagicMock(side_effect=Exception("database down"))
+    try:
+        with patch.object(db.session, 'execute', failing_execute), \
+             patch('webapp.User.query') as user_query:
+            assert client.get('/healthz').status_code == 503
+            assert degraded_mode.is_set()
+
+            response = client.get('/v1/user/self', headers=headers)
+            assert response.status_code == 200
+            assert response.json['email'] == "a@example.com"
+            user_query.filter_by.assert_not_called()
+
+            # Wrong password and unknown users cannot be checked without the database
+            response = client.get('/v1/user/self', headers={'Authorization': 'Basic ' + base64.b64encode(b"a@example.com:wrongpassword").decode()})
+            assert response.status_code == 503
+
+            response = client.put('/v1/user/self', headers=headers, json={
+                "first_name": "New", "last_name": "Name", "password": "password123"})
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '30'
+
+        assert client.get('/healthz').status_code == 200
+        assert not degraded_mode.is_set()
+    finally:
+        degraded_mode.clear()
+
+def test_degraded_picture_routes_need_cached_pictures(client, degraded_cache):
+    from webapp import degraded_mode
+    with client.application.app_context():
+        make_verified_user("nopics@example.com")
+        make_verified_user("emptypics@example.com")
+        db.session.commit()
+
+    # The first user's pictures were never loaded; the second's were, and there are none
+    assert client.get('/v1/user/self', headers=basic_auth("nopics@example.com")).status_code == 200
+    assert client.get('/v1/user/self/pic', headers=basic_auth("emptypics@example.com")).status_code == 404
+
+    failing_execute = MagicMock(side_effect=Exception("database down"))
+    try:
+        with patch.object(db.session, 'execute', failing_execute):
+            assert client.get('/healthz').status_code == 503
+            for path in ('/v1/user/self/pic', '/v1/user/self/pic/file'):
+                response = client.get(path, headers=basic_auth("nopics@example.com"))
+                assert response.status_code == 503
+                assert response.headers['Retry-After'] == '30'
+                assert client.get(path, headers=basic_auth("emptypics@example.com")).status_code == 404
+    finally:
+        degraded_mode.clear()
+
+@pytest.fixture
+def shards(client, tmp_path):
+    from webapp import shard_router, create_shard_tables
+    shard_router.configure([f"sqlite:///{tmp_path / 'shard1.db'}"])
+    create_shard_tables()
+    yield shard_router
+    shard_router.configure([])
+
+def email_on_shard(router, shard):
+    return next(f"user{i}@example.com" for i in range(100)
+                if router.shard_for_email(f"user{i}@example.com") == shard)
+
+def shard_emails(router, shard):
+    with router.engine(shard).connect() as conn:
+        return {row.email for row in conn.execute(db.select(User.__table__.c.email))}
+
+def test_users_are_routed_to_shard_by_email(client, mock_aws, shards):
+    for shard in range(shards.count):
+        email = email_on_shard(shards, shard)
+        response = client.post('/v1/user', json={"first_name": "John", "last_name": "Doe",
+                                                 "email": email, "password": "password123"})
+        assert response.status_code == 201
+        assert shard_emails(shards, shard) == {email}
+
+        with shards.engine(shard).begin() as conn:
+            conn.execute(db.update(User.__table__).where(User.__table__.c.email == email).values(is_verified=True))
+        response = client.get('/v1/user/self', headers=basic_auth(email))
+        assert response.status_code == 200
+        assert response.get_json()['email'] == email
+
+def test_rebalance_moves_misplaced_users(client, shards):
+    from webapp import rebalance_shards
+    email = email_on_shard(shards, 1)
+    with client.application.app_context():
+        make_verified_user(email)
+        db.session.commit()
+
+    # Other shards are only consulted while a rebalance from the old layout is pending
+    assert client.get('/v1/user/self', headers=basic_auth(email)).status_code == 401
+    shards.previous_count = 1
+    assert client.get('/v1/user/self', headers=basic_auth(email)).status_code == 200
+
+    with client.application.app_context():
+        assert rebalance_shards(dry_run=True) == 1
+        assert rebalance_shards() == 1
+        assert rebalance_shards() == 0
+    assert shard_emails(shards, 0) == set()
+    assert shard_emails(shards, 1) == {email}
+    assert client.get('/v1/user/self', headers=basic_auth(email)).status_code == 200
+
+def test_signup_rejects_email_still_on_old_shard(client, mock_aws, shards):
+    email = email_on_shard(shards, 1)
+    with client.application.app_context():
+        make_verified_user(email)
+        db.session.commit()
+    shards.previous_count = 1
+
+    response = client.post('/v1/user', json={"first_name": "John", "last_name": "Doe",
+                                             "email": email, "password": "password123"})
+    assert response.status_code == 400
+    assert shard_emails(shards, 0) == {email}
+    assert shard_emails(shards, 1) == set()
+
+SIGNUP = {"first_name": "John", "last_name": "Doe", "email": "john@example.com", "password": "password123"}
+
+def test_duplicate_signup_is_rejected_by_unique_index(client, mock_aws):
+    assert client.post('/v1/user', json=SIGNUP).status_code == 201
+    assert client.post('/v1/user', json=SIGNUP).status_code == 400
+    with client.application.app_context():
+        assert User.query.filter_by(email=SIGNUP['email']).count() == 1
+
+def test_email_filter_rejects_known_email_before_hashing(client, mock_aws):
+    from webapp import EmailBloomFilter, warm_email_filter
+    with patch('webapp.email_filter', EmailBloomFilter(1000, 0.01)) as email_filter:
+        with client.application.app_context():
+            make_verified_user(SIGNUP['email'])
+            db.session.commit()
+            assert warm_email_filter() == 1
+        assert SIGNUP['email'] in email_filter
+        assert "other@example.com" not in email_filter
+
+        with patch.object(User, 'set_password') as set_password:
+            assert client.post('/v1/user', json=SIGNUP).status_code == 400
+        set_password.assert_not_called()
+
+        # A filter hit for a deleted account falls through to the database and succeeds
+        with client.application.app_context():
+            User.query.delete()
+            db.session.commit()
+        assert client.post('/v1/user', json=SIGNUP).status_code == 201
+
+def test_read_routes_authenticate_without_loading_the_entity(client):
+    import webapp
+    with client.application.app_context():
+        make_verified_user("slim@example.com")
+        db.session.commit()
+
+    with patch.object(webapp.statsd_client, 'incr') as incr:
+        response = client.get('/v1/user/self', headers=basic_auth("slim@example.com"))
+        assert response.status_code == 200
+        assert response.get_json()['email'] == "slim@example.com"
+        assert 'auth.principal.upgrade' not in [c.args[0] for c in incr.call_args_list]
+
+        response = client.put('/v1/user/self', headers=basic_auth("slim@example.com"),
+                              json={"first_name": "Slim", "last_name": "Shady", "password": "password123"})
+        assert response.status_code == 200
+        assert response.get_json()['first_name'] == "Slim"
+        assert 'auth.principal.upgrade' in [c.args[0] for c in incr.call_args_list]
+
+def test_metrics_endpoint_is_opt_in(client):
+    assert client.get('/metrics').status_code == 404
+
+def test_metrics_endpoint_reports_requests_and_breakers(client, breakers):
+    prometheus_client = pytest.importorskip('prometheus_client')
+    from webapp import PrometheusMetrics
+    with patch('webapp.metrics', PrometheusMetrics(prometheus_client.CollectorRegistry())):
+        breakers['s3'].reset()
+        assert client.get('/healthz').status_code == 200
+        assert client.get('/healthz').status_code == 200
+
+        response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert 'webapp_http_requests_total{method="GET",route="health_check",status="200"} 2.0' in body
+    assert 'webapp_http_request_duration_seconds_bucket{le="+Inf",method="GET",route="health_check",status="200"} 2.0' in body
+    assert 'webapp_breaker_state{dependency="s3"} 0.0' in body
+
+def test_throttled_s3_opens_breaker_and_uploads_fail_fast(client, breakers):
+    from fault_injection import FaultProfile, FaultyS3Client
+    from webapp import S3Storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+
+    s3 = FaultyS3Client(FaultProfile(median_ms=1, throttle_rate=1.0, seed=1))
+    statuses = []
+    with patch('webapp.storage', new=S3Storage(s3, 'test-bucket')):
+        for _ in range(client.application.config['BREAKER_MIN_CALLS'] + 3):
+            data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+            statuses.append(client.post('/v1/user/self/pic', headers=basic_auth("a@example.com"),
+                                        data=data, content_type='multipart/form-data').status_code)
+    assert statuses.count(500) == client.application.config['BREAKER_MIN_CALLS']
+    assert statuses[-3:] == [503, 503, 503]
+    assert s3.profile.calls == client.application.config['BREAKER_MIN_CALLS']
+
+def test_sns_timeout_defers_verification_message(client, breakers):
+    from fault_injection import FaultProfile, FaultySNSClient
+    from webapp import PendingNotification
+    sns = FaultySNSClient(FaultProfile(median_ms=50, timeout_ms=10))
+    with patch('webapp.sns_client', new=sns), patch('webapp.TESTING', new=False):
+        response = client.post('/v1/user', json=SIGNUP)
+    assert response.status_code == 201
+    assert sns.published == []
+    with client.application.app_context():
+        assert PendingNotification.query.count() == 1
+
+def test_database_latency_shows_in_server_timing(client):
+    from fault_injection import FaultProfile, inject_db_faults
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+        engine = db.engine
+
+    with inject_db_faults(engine, FaultProfile(median_ms=20)):
+        response = client.get('/v1/user/self', headers=basic_auth("a@example.com"))
+    assert response.status_code == 200
+    db_timing = next(entry for entry in response.headers['Server-Timing'].split(', ') if entry.startswith('db;'))
+    assert float(db_timing.split('dur=')[1].split(';')[0]) >= 20
+
+def gallery_upload(client, email, *payloads):
+    data = {'images': [(io.BytesIO(payload), f"img{i}.png") for i, payload in enumerate(payloads)]}
+    return client.post('/v1/user/self/images', headers=basic_auth(email), data=data, content_type='multipart/form-data')
+
+def test_gallery_batch_upload_list_and_bulk_delete(client):
+    from webapp import storage
+    with client.application.app_context():
+        make_verified_user("g@example.com")
+        db.session.commit()
+    other_png = PNG_BYTES + b'other'
+
+    response = gallery_upload(client, "g@example.com", PNG_BYTES + b'gallery', other_png, other_png)
+    assert response.status_code == 201
+    uploaded = response.get_json()['images']
+    assert len(uploaded) == 3
+    assert len(storage.objects) == 2
+
+    # Gallery images are not the profile picture, and do not block uploading one
+    assert client.get('/v1/user/self/pic', headers=basic_auth("g@example.com")).status_code == 404
+    upload_and_download(client, basic_auth("g@example.com"))
+
+    response = client.get('/v1/user/self/images?limit=2', headers=basic_auth("g@example.com"))
+    assert response.status_code == 200
+    first_page = response.get_json()
+    assert len(first_page['images']) == 2
+    response = client.get(f"/v1/user/self/images?limit=2&cursor={first_page['next_cursor']}",
+                          headers=basic_auth("g@example.com"))
+    second_page = response.get_json()
+    assert second_page['next_cursor'] is None
+    listed = {image['id'] for image in first_page['images'] + second_page['images']}
+    assert listed == {image['id'] for image in uploaded}
+    for bad in (["2024-01-01T00:00:00", {"a": 1}], ["2024-01-01T00:00:00"], {"a": 1}):
+        cursor = base64.urlsafe_b64encode(json.dumps(bad).encode()).decode()
+        response = client.get(f"/v1/user/self/images?cursor={cursor}", headers=basic_auth("g@example.com"))
+        assert response.status_code == 400
+
+    response = client.delete('/v1/user/self/images', headers=basic_auth("g@example.com"),
+                             json={"ids": [uploaded[0]['id'], uploaded[1]['id'], str(uuid.uuid4())]})
+    assert response.status_code == 204
+    response = client.get('/v1/user/self/images', headers=basic_auth("g@example.com"))
+    assert [image['id'] for image in response.get_json()['images']] == [uploaded[2]['id']]
+    assert client.get('/v1/user/self/pic', headers=basic_auth("g@example.com")).status_code == 200
+
+def test_gallery_rejects_batch_with_invalid_image(client):
+    from webapp import storage
+    with client.application.app_context():
+        make_verified_user("g@example.com")
+        db.session.commit()
+
+    response = gallery_upload(client, "g@example.com", PNG_BYTES + b'fine', b'not an image')
+    assert response.status_code == 400
+    assert storage.objects == {}
+    response = client.get('/v1/user/self/images', headers=basic_auth("g@example.com"))
+    assert response.get_json() == {"images": [], "next_cursor": None}
+
+def test_small_responses_are_not_compressed(client):
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+    response = client.get('/v1/user/self', headers={**basic_auth("a@example.com"), 'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+def test_list_responses_are_compressed_and_cached(client, admin_headers):
+    import gzip
+    from webapp import compressed_body_cache
+    with client.application.app_context():
+        add_users(30)
+    plain = client.get('/v1/admin/users', headers=admin_headers)
+    assert 'Content-Encoding' not in plain.headers
+
+    for encoding, decompress in (('gzip', gzip.decompress),
+                                 ('br', lambda body: pytest.importorskip('brotli').decompress(body)),
+                                 ('zstd', lambda body: pytest.importorskip('zstandard').ZstdDecompressor()
+                                  .decompressobj().decompress(body))):
+        response = client.get('/v1/admin/users', headers={**admin_headers, 'Accept-Encoding': encoding})
+        assert response.headers['Content-Encoding'] == encoding
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert decompress(response.get_data()) == plain.get_data()
+
+    cached = len(compressed_body_cache.entries)
+    response = client.get('/v1/admin/users', headers={**admin_headers, 'Accept-Encoding': 'gzip, br;q=0.5'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(compressed_body_cache.entries) == cached
+
+    # Bodies over the cache limit are compressed without being hashed or cached
+    with patch.dict(client.application.config, {'COMPRESSION_CACHE_MAX_BODY_BYTES': 0}), \
+         patch('webapp.hashlib.sha256', wraps=hashlib.sha256) as sha256:
+        response = client.get('/v1/admin/users', headers={**admin_headers, 'Accept-Encoding': 'gzip'})
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    sha256.assert_not_called()
+    assert len(compressed_body_cache.entries) == cached
+
+def test_streamed_export_is_compressed(client, admin_headers):
+    import zlib
+    with client.application.app_context():
+        add_users(5)
+    plain = client.get('/v1/admin/users/export', headers=admin_headers).get_data()
+    response = client.get('/v1/admin/users/export', headers={**admin_headers, 'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert zlib.decompress(response.get_data(), 31) == plain
+
+def test_blob_reclaimed_only_at_zero_references(client):
+    from webapp import Blob, StorageCleanupTask, process_storage_cleanup, storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        make_verified_user("b@example.com")
+        db.session.commit()
+
+    content_hash = hashlib.sha256(PNG_BYTES).hexdigest()
+    data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+    assert client.post('/v1/user/self/pic', headers=basic_auth("a@example.com"),
+                       data=data, content_type='multipart/form-data').status_code == 201
+    assert db.session.get(Blob, content_hash).refcount == 1
+
+    # The delete queues cleanup after the grace period; a re-upload meanwhile takes the blob back
+    assert client.delete('/v1/user/self/pic', headers=basic_auth("a@example.com")).status_code == 204
+    task = StorageCleanupTask.query.one()
+    assert task.next_attempt_at > datetime.utcnow()
+    assert db.session.get(Blob, content_hash).refcount == 0
+
+    with patch.object(storage, 'put') as put:
+        data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+        assert client.post('/v1/user/self/pic', headers=basic_auth("b@example.com"),
+                           data=data, content_type='multipart/form-data').status_code == 201
+    put.assert_not_called()
+
+    task.next_attempt_at = datetime.utcnow()
+    db.session.commit()
+    assert process_storage_cleanup() == 0
+    assert f"blobs/{content_hash}" in storage.objects
+    assert db.session.get(Blob, content_hash).refcount == 1
+    assert StorageCleanupTask.query.count() == 0
+
+def test_new_blob_queued_for_cleanup_when_image_commit_fails(client):
+    from webapp import StorageCleanupTask, storage
+    with client.application.app_context():
+        make_verified_user("a@example.com")
+        db.session.commit()
+
+    commit = db.session.commit
+    calls = []
+    def failing_first_commit():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Exception("connection lost")
+        commit()
+
+    data = {'profilePic': (io.BytesIO(PNG_BYTES), 'me.png')}
+    with patch.object(db.session, 'commit', side_effect=failing_first_commit):
+        response = client.post('/v1/user/self/pic', headers=basic_auth("a@example.com"),
+                               data=data, content_type='multipart/form-data')
+    assert response.status_code == 500
+    key = f"blobs/{hashlib.sha256(PNG_BYTES).hexdigest()}"
+    assert key in storage.objects
+    assert [task.prefix for task in StorageCleanupTask.query.all()] == [key]
+
+def test_user_cache_disabled_by_default(client):
+    from webapp import degraded_mode, user_cache
+    with client.application.app_context():
+        make_verified_user("uncached@example.com")
+        db.session.commit()
+
+    assert client.get('/v1/user/self', headers=basic_auth("uncached@example.com")).status_code == 200
+    assert "uncached@example.com" not in user_cache.entries
+
+    degraded_mode.set()
+    try:
+        response = client.get('/v1/user/self', headers=basic_auth("uncached@example.com"))
+        assert response.status_code == 503
+    finally:
+        degraded_mode.clear()
+
 if __name__ == '__main__':
     pytest.main(['-v'])
\ No newline at end of file
@@ -48,13 +48,17 @@ class TestValidators(unittest.TestCase):
         cls.mocks[0].side_effect = mock_boto3_client
         
         # Import webapp after mocking
-        from webapp import app, db, User, validate_email, validate_name, validate_password
+        from webapp import (app, db, User, validate_email, validate_name, validate_password,
+                            validate_payload, USER_CREATE_SCHEMA, USER_UPDATE_SCHEMA)
         cls.app = app
         cls.db = db
         cls.User = User
         cls.validate_email = staticmethod(validate_email)
         cls.validate_name = staticmethod(validate_name)
         cls.validate_password = staticmethod(validate_password)
+        cls.validate_payload = staticmethod(validate_payload)
+        cls.USER_CREATE_SCHEMA = USER_CREATE_SCHEMA
+        cls.USER_UPDATE_SCHEMA = USER_UPDATE_SCHEMA
 
     def setUp(self):
         self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
@@ -75,6 +79,26 @@ class TestValidators(unittest.TestCase):
 
     # Existing test methods remain unchanged
 
+    def test_validate_payload(self):
+        """Test schema validation reports the first failing rule"""
+        valid = {
+            "first_name": "John",
+            "last_name": "Doe",
+            "email": "john@example.com",
+            "password": "password123"
+        }
+        self.assertIsNone(self.validate_payload(valid, self.USER_CREATE_SCHEMA))
+        self.assertEqual(self.validate_payload({}, self.USER_CREATE_SCHEMA), 'no_data')
+        self.assertEqual(self.validate_payload(["John"], self.USER_CREATE_SCHEMA), 'no_data')
+        self.assertEqual(
+            self.validate_payload({"first_name": "John"}, self.USER_UPDATE_SCHEMA), 'missing_fields')
+        self.assertEqual(
+            self.validate_payload({**valid, "last_name": 42}, self.USER_CREATE_SCHEMA), 'invalid_name')
+        self.assertEqual(
+            self.validate_payload({**valid, "email": "nope"}, self.USER_CREATE_SCHEMA), 'invalid_email')
+        self.assertEqual(
+            self.validate_payload({**valid, "password": "short"}, self.USER_UPDATE_SCHEMA), 'invalid_password')
+
     def test_user_creation_with_sns(self):
         """Test user creation with SNS notification"""
         with self.app.test_client() as client:
@@ -1,23 +1,63 @@
-from flask import Flask, json, request, jsonify
+from flask import Flask, Request, json, request, jsonify, g, has_request_context, has_app_context, stream_with_context, send_file, redirect
+from flask.json.provider import DefaultJSONProvider
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from flask_httpauth import HTTPBasicAuth
+from flask_sqlalchemy.session import Session as FlaskSession
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from sqlalchemy import text
+from sqlalchemy import text, event, create_engine, exc, select, insert, delete, or_, and_
+from sqlalchemy.orm import joinedload
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.engine import Engine, Row
+from sqlalchemy.pool import QueuePool
 from logging.handlers import RotatingFileHandler
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import re
 import os
 import uuid
 import logging
+import secrets
+import hashlib
+import hmac
+import base64
+import csv
+import io
+import shutil
+import tempfile
+import threading
+import gzip
+import heapq
+import itertools
+import math
+import click
 import boto3
 from botocore.exceptions import ClientError
+from botocore.config import Config as BotoConfig
+from collections import deque, OrderedDict
 import watchtower
 import statsd
 import time
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Create logs directory if it doesn't exist
 if not os.path.exists('logs'):
@@ -59,7 +99,50 @@ verify_env_vars()
 # Check if we're in test mode
 TESTING = os.getenv('TESTING', 'False').lower() == 'true'
 
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype
+        )
+
+# Bytes kept from the start of each upload for content sniffing
+UPLOAD_SNIFF_BYTES = 16
+
+class HashingFile:
+    # Wraps the spool werkzeug writes multipart uploads into, hashing the bytes as they arrive
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.head = b''
+
+    def write(self, data):
+        self.sha256.update(data)
+        if len(self.head) < UPLOAD_SNIFF_BYTES:
+            self.head += bytes(data[:UPLOAD_SNIFF_BYTES - len(self.head)])
+        return self.stream.write(data)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(super()._get_file_stream(total_content_length, content_type, filename, content_length))
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # Database Configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
@@ -71,13 +154,435 @@ app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
 app.config['AWS_REGION'] = os.getenv('AWS_REGION', 'us-east-1')
 app.config['AWS_BUCKET_NAME'] = os.getenv('AWS_BUCKET_NAME')
 
-db = SQLAlchemy(app)
+# Queries slower than this are logged with the route that issued them
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '100'))
+
+# Verification tokens and the reaper for accounts that never verified
+app.config['VERIFICATION_TOKEN_TTL_MINUTES'] = int(os.getenv('VERIFICATION_TOKEN_TTL_MINUTES', '2'))
+# Links issued before random tokens were user_id + SECRET_TOKEN; they are honoured until they expire
+app.config['SECRET_TOKEN'] = os.getenv('SECRET_TOKEN')
+app.config['TOKEN_REAPER_INTERVAL_SECONDS'] = int(os.getenv('TOKEN_REAPER_INTERVAL_SECONDS', '300'))
+app.config['TOKEN_REAPER_BATCH_SIZE'] = int(os.getenv('TOKEN_REAPER_BATCH_SIZE', '500'))
+app.config['TOKEN_REAPER_MAX_BATCHES'] = int(os.getenv('TOKEN_REAPER_MAX_BATCHES', '20'))
+
+# Picture storage: s3, local or memory
+app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'memory' if TESTING else 's3')
+app.config['STORAGE_LOCAL_ROOT'] = os.getenv('STORAGE_LOCAL_ROOT', 'storage')
+app.config['STORAGE_URL_EXPIRY_SECONDS'] = int(os.getenv('STORAGE_URL_EXPIRY_SECONDS', '300'))
+# Hand local file downloads to the front-end server (nginx X-Accel/X-Sendfile) when it is configured for it
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'False').lower() == 'true'
+
+# Gallery: batch uploads go to storage concurrently through a bounded pool shared by all requests
+app.config['GALLERY_MAX_BATCH'] = int(os.getenv('GALLERY_MAX_BATCH', '10'))
+app.config['GALLERY_UPLOAD_WORKERS'] = int(os.getenv('GALLERY_UPLOAD_WORKERS', '8'))
+app.config['GALLERY_PAGE_SIZE'] = int(os.getenv('GALLERY_PAGE_SIZE', '50'))
+app.config['GALLERY_PAGE_SIZE_MAX'] = int(os.getenv('GALLERY_PAGE_SIZE_MAX', '200'))
+app.config['GALLERY_DELETE_MAX'] = int(os.getenv('GALLERY_DELETE_MAX', '100'))
+
+# Response compression for JSON, NDJSON and CSV bodies
+app.config['COMPRESSION_MIN_BYTES'] = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+app.config['COMPRESSION_CACHE_SIZE'] = int(os.getenv('COMPRESSION_CACHE_SIZE', '1024'))
+app.config['COMPRESSION_CACHE_MAX_BODY_BYTES'] = int(os.getenv('COMPRESSION_CACHE_MAX_BODY_BYTES', '65536'))
+
+# Background cleanup of stored objects for deleted accounts
+app.config['STORAGE_CLEANUP_INTERVAL_SECONDS'] = int(os.getenv('STORAGE_CLEANUP_INTERVAL_SECONDS', '30'))
+app.config['STORAGE_CLEANUP_TASKS_PER_RUN'] = int(os.getenv('STORAGE_CLEANUP_TASKS_PER_RUN', '20'))
+app.config['STORAGE_CLEANUP_RETRY_BASE_SECONDS'] = int(os.getenv('STORAGE_CLEANUP_RETRY_BASE_SECONDS', '30'))
+app.config['STORAGE_CLEANUP_RETRY_MAX_SECONDS'] = int(os.getenv('STORAGE_CLEANUP_RETRY_MAX_SECONDS', '3600'))
+app.config['BLOB_CLEANUP_GRACE_SECONDS'] = int(os.getenv('BLOB_CLEANUP_GRACE_SECONDS', '300'))
+
+# Fail fast on AWS dependencies: tight botocore timeouts plus per-dependency circuit breakers
+app.config['AWS_CONNECT_TIMEOUT_SECONDS'] = float(os.getenv('AWS_CONNECT_TIMEOUT_SECONDS', '2'))
+app.config['AWS_READ_TIMEOUT_SECONDS'] = float(os.getenv('AWS_READ_TIMEOUT_SECONDS', '5'))
+app.config['AWS_MAX_ATTEMPTS'] = int(os.getenv('AWS_MAX_ATTEMPTS', '2'))
+app.config['BREAKER_WINDOW_SECONDS'] = float(os.getenv('BREAKER_WINDOW_SECONDS', '30'))
+app.config['BREAKER_MIN_CALLS'] = int(os.getenv('BREAKER_MIN_CALLS', '10'))
+app.config['BREAKER_ERROR_RATE'] = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+app.config['BREAKER_SLOW_CALL_SECONDS'] = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', '2'))
+app.config['BREAKER_SLOW_CALL_RATE'] = float(os.getenv('BREAKER_SLOW_CALL_RATE', '0.8'))
+app.config['BREAKER_OPEN_SECONDS'] = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+app.config['BREAKER_HALF_OPEN_PROBES'] = int(os.getenv('BREAKER_HALF_OPEN_PROBES', '1'))
+app.config['NOTIFICATION_INTERVAL_SECONDS'] = int(os.getenv('NOTIFICATION_INTERVAL_SECONDS', '15'))
+
+# Degraded read-only mode: serve cached users when the health probe finds the database down.
+# Off by default: the cache costs an HMAC per login and holds password verifiers in memory.
+app.config['DEGRADED_CACHE_ENABLED'] = os.getenv('DEGRADED_CACHE_ENABLED', 'False').lower() == 'true'
+app.config['DEGRADED_CACHE_SIZE'] = int(os.getenv('DEGRADED_CACHE_SIZE', '10000'))
+app.config['DEGRADED_CACHE_TTL_SECONDS'] = int(os.getenv('DEGRADED_CACHE_TTL_SECONDS', '3600'))
+app.config['DEGRADED_RETRY_AFTER_SECONDS'] = int(os.getenv('DEGRADED_RETRY_AFTER_SECONDS', '30'))
+app.config['DATABASE_PROBE_INTERVAL_SECONDS'] = int(os.getenv('DATABASE_PROBE_INTERVAL_SECONDS', '10'))
+
+# Idempotency-Key handling for POST /v1/user and picture uploads
+app.config['IDEMPOTENCY_TTL_SECONDS'] = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+app.config['IDEMPOTENCY_WAIT_SECONDS'] = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '10'))
+app.config['IDEMPOTENCY_LOCK_TIMEOUT_SECONDS'] = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT_SECONDS', '60'))
+app.config['IDEMPOTENCY_CLEANUP_INTERVAL_SECONDS'] = int(os.getenv('IDEMPOTENCY_CLEANUP_INTERVAL_SECONDS', '600'))
+
+# Admin API
+app.config['ADMIN_API_TOKEN'] = os.getenv('ADMIN_API_TOKEN')
+app.config['ADMIN_PAGE_SIZE'] = int(os.getenv('ADMIN_PAGE_SIZE', '100'))
+app.config['ADMIN_PAGE_SIZE_MAX'] = int(os.getenv('ADMIN_PAGE_SIZE_MAX', '1000'))
+app.config['EXPORT_BATCH_SIZE'] = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+
+# Optional in-process Bloom filter of registered emails, checked before hashing a signup password
+app.config['EMAIL_BLOOM_FILTER_ENABLED'] = os.getenv('EMAIL_BLOOM_FILTER_ENABLED', 'False').lower() == 'true'
+app.config['EMAIL_BLOOM_FILTER_CAPACITY'] = int(os.getenv('EMAIL_BLOOM_FILTER_CAPACITY', '1000000'))
+app.config['EMAIL_BLOOM_FILTER_ERROR_RATE'] = float(os.getenv('EMAIL_BLOOM_FILTER_ERROR_RATE', '0.01'))
+
+# Horizontal sharding of the user and image tables; SQLALCHEMY_DATABASE_URI is shard 0
+app.config['SQLALCHEMY_SHARD_URIS'] = [uri.strip() for uri in os.getenv('SQLALCHEMY_SHARD_URIS', '').split(',') if uri.strip()]
+# Shard count (including shard 0) before URIs were appended; set only until rebalance-shards has finished
+app.config['SHARD_REBALANCE_PREVIOUS_COUNT'] = int(os.getenv('SHARD_REBALANCE_PREVIOUS_COUNT', '0'))
+
+# Read replicas for read-only routes
+app.config['SQLALCHEMY_REPLICA_URIS'] = [uri.strip() for uri in os.getenv('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri.strip()]
+app.config['REPLICA_EJECT_SECONDS'] = int(os.getenv('REPLICA_EJECT_SECONDS', '30'))
+app.config['REPLICA_PROBE_INTERVAL_SECONDS'] = int(os.getenv('REPLICA_PROBE_INTERVAL_SECONDS', '10'))
+app.config['READ_YOUR_WRITES_SECONDS'] = int(os.getenv('READ_YOUR_WRITES_SECONDS', '5'))
+
+class ReplicaPool:
+    def __init__(self):
+        self.engines = []
+        self.ejected_until = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def configure(self, uris):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(uri, pool_pre_ping=True) for uri in uris]
+        self.ejected_until = {}
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self.on_error)
+
+    def pick(self):
+        # Round robin over replicas that are not ejected; None falls back to the primary
+        with self.lock:
+            now = time.monotonic()
+            for _ in range(len(self.engines)):
+                engine = self.engines[self.next_index % len(self.engines)]
+                self.next_index += 1
+                if self.ejected_until.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def eject(self, engine):
+        self.ejected_until[engine] = time.monotonic() + app.config['REPLICA_EJECT_SECONDS']
+        statsd_client.incr('database.replica.ejected')
+        logger.warning(f"Ejecting read replica {engine.url.render_as_string(hide_password=True)}")
+
+    def on_error(self, context):
+        if isinstance(context.sqlalchemy_exception, exc.OperationalError):
+            self.eject(context.engine)
+
+    def probe(self):
+        healthy = 0
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1'))
+                self.ejected_until.pop(engine, None)
+                healthy += 1
+            except Exception:
+                self.eject(engine)
+        statsd_client.gauge('database.replica.healthy', healthy)
+        return healthy
+
+replica_pool = ReplicaPool()
+replica_pool.configure(app.config['SQLALCHEMY_REPLICA_URIS'])
+
+# Read-only endpoints whose queries, including the auth lookup, may be served by a replica
+REPLICA_READ_ENDPOINTS = {'get_user', 'get_profile_pic', 'download_profile_pic', 'list_gallery_images', 'list_users', 'export_users'}
+
+# email -> monotonic deadline until which that user's reads stay on the primary, oldest deadline first
+recent_writers = OrderedDict()
+recent_writers_lock = threading.Lock()
+
+def mark_recent_write(email):
+    if email and replica_pool.engines:
+        now = time.monotonic()
+        with recent_writers_lock:
+            recent_writers.pop(email, None)
+            recent_writers[email] = now + app.config['READ_YOUR_WRITES_SECONDS']
+            # The window is fixed, so expired entries are always at the front
+            while recent_writers and next(iter(recent_writers.values())) <= now:
+                recent_writers.popitem(last=False)
+
+def wrote_recently(email):
+    deadline = recent_writers.get(email)
+    return deadline is not None and deadline > time.monotonic()
+
+class ShardRouter:
+    def __init__(self):
+        self.engines = []
+
+    def configure(self, uris, previous_count=0):
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [create_engine(uri, pool_pre_ping=True) for uri in uris]
+        self.previous_count = previous_count
+
+    @property
+    def count(self):
+        return len(self.engines) + 1
+
+    def email_hash(self, email):
+        return int.from_bytes(hashlib.sha256(email.encode()).digest()[:8], 'big')
+
+    def shard_for_email(self, email):
+        # Basic Auth arrives with the email, so the email alone must locate the user
+        if not self.engines:
+            return 0
+        return self.email_hash(email) % self.count
+
+    def previous_shard_for_email(self, email):
+        # Where the email hashed before URIs were appended, if that differs from its shard now
+        if not self.previous_count:
+            return None
+        shard = self.email_hash(email) % self.previous_count
+        return shard if shard != self.shard_for_email(email) else None
+
+    def engine(self, shard):
+        return db.engine if shard == 0 else self.engines[shard - 1]
+
+shard_router = ShardRouter()
+shard_router.configure(app.config['SQLALCHEMY_SHARD_URIS'], app.config['SHARD_REBALANCE_PREVIOUS_COUNT'])
+
+SHARDED_TABLES = {'user', 'image'}
+
+def current_shard():
+    return g.get('db_shard', 0) if has_app_context() else 0
+
+@contextmanager
+def use_shard(shard):
+    previous = g.get('db_shard', 0)
+    g.db_shard = shard
+    try:
+        yield shard
+    finally:
+        g.db_shard = previous
+
+def each_shard():
+    for shard in range(shard_router.count):
+        with use_shard(shard):
+            yield shard
+
+def current_replica():
+    if not replica_pool.engines or not has_request_context() or not g.get('db_use_replica'):
+        return None
+    if current_shard() != 0:
+        return None
+    if 'db_replica' not in g:
+        g.db_replica = replica_pool.pick()
+    return g.db_replica
+
+class RoutingSession(FlaskSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and shard_router.engines and mapper is not None \
+                and mapper.local_table.name in SHARDED_TABLES:
+            shard = current_shard()
+            if shard:
+                return shard_router.engine(shard)
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            replica = current_replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 auth = HTTPBasicAuth()
+admin_auth = HTTPTokenAuth(scheme='Bearer')
 migrate = Migrate(app, db)
 
 # Configure StatsD for metrics
 statsd_client = statsd.StatsClient('localhost', 8125)
 
+# Opt-in Prometheus /metrics alongside StatsD. Imported after load_dotenv because prometheus_client
+# picks its multiprocess value store from PROMETHEUS_MULTIPROC_DIR at import time.
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'False').lower() == 'true'
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess as prometheus_multiprocess
+except ImportError:
+    prometheus_client = None
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class PrometheusMetrics:
+    def __init__(self, registry):
+        self.registry = registry
+        self.requests = prometheus_client.Counter(
+            'webapp_http_requests_total', 'HTTP requests', ['method', 'route', 'status'], registry=registry)
+        self.latency = prometheus_client.Histogram(
+            'webapp_http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'],
+            buckets=LATENCY_BUCKETS, registry=registry)
+        self.db_pool = prometheus_client.Gauge(
+            'webapp_db_pool_connections', 'Primary database pool connections', ['state'],
+            multiprocess_mode='livesum', registry=registry)
+        self.dependency_latency = prometheus_client.Histogram(
+            'webapp_dependency_call_duration_seconds', 'Calls to AWS dependencies', ['dependency', 'outcome'],
+            buckets=LATENCY_BUCKETS, registry=registry)
+        self.breaker_rejections = prometheus_client.Counter(
+            'webapp_breaker_rejections_total', 'Calls rejected by an open circuit breaker', ['dependency'],
+            registry=registry)
+        # 0 closed, 1 half open, 2 open; the worst state across workers is reported
+        self.breaker_state = prometheus_client.Gauge(
+            'webapp_breaker_state', 'Circuit breaker state', ['dependency'],
+            multiprocess_mode='max', registry=registry)
+
+    def observe_request(self, method, route, status, duration):
+        self.requests.labels(method, route, status).inc()
+        self.latency.labels(method, route, status).observe(duration)
+
+    def observe_pool(self, pool):
+        # StaticPool and NullPool (SQLite) keep no counts
+        if isinstance(pool, QueuePool):
+            self.db_pool.labels('checked_out').set(pool.checkedout())
+            self.db_pool.labels('idle').set(pool.checkedin())
+            self.db_pool.labels('overflow').set(max(pool.overflow(), 0))
+
+    def render(self):
+        registry = self.registry
+        if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+            # Each pre-forked worker writes mmap'd files there; merge them at scrape time
+            registry = prometheus_client.CollectorRegistry()
+            prometheus_multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry)
+
+metrics = None
+if app.config['METRICS_ENABLED']:
+    if prometheus_client is None:
+        logger.warning("METRICS_ENABLED is set but prometheus_client is not installed; /metrics is disabled")
+    else:
+        metrics = PrometheusMetrics(prometheus_client.REGISTRY)
+
+def mark_metrics_worker_dead(pid):
+    # Call from the server's worker-exit hook so dead workers' live gauges are dropped
+    if prometheus_client is not None and os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        prometheus_multiprocess.mark_process_dead(pid)
+
+class CircuitOpenError(Exception):
+    def __init__(self, name):
+        super().__init__(f"Circuit breaker {name} is open")
+        self.name = name
+
+# Codes AWS uses to ask callers to back off; these count against the breaker like 5xx errors
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'SlowDown', 'RequestLimitExceeded', 'TooManyRequestsException'}
+
+def is_dependency_failure(error):
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+        return code in THROTTLING_ERROR_CODES or status >= 500
+    return True
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.calls = deque()  # (finished_at, failed, slow) within the rolling window
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        if metrics is not None:
+            metrics.breaker_state.labels(self.name).set(0)
+
+    def transition(self, state):
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        if state == self.CLOSED:
+            self.calls.clear()
+        self.probes_in_flight = 0
+        statsd_client.gauge(f'breaker.{self.name}.state', self.STATE_VALUES[state])
+        if metrics is not None:
+            metrics.breaker_state.labels(self.name).set(self.STATE_VALUES[state])
+        logger.warning(f"Circuit breaker {self.name} is now {state}")
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < app.config['BREAKER_OPEN_SECONDS']:
+                    return False
+                self.transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self.probes_in_flight >= app.config['BREAKER_HALF_OPEN_PROBES']:
+                    return False
+                self.probes_in_flight += 1
+            return True
+
+    def record(self, failed, duration):
+        if metrics is not None:
+            metrics.dependency_latency.labels(self.name, 'failure' if failed else 'success').observe(duration)
+        slow = duration >= app.config['BREAKER_SLOW_CALL_SECONDS']
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.transition(self.OPEN if failed or slow else self.CLOSED)
+                return
+
+            now = time.monotonic()
+            self.calls.append((now, failed, slow))
+            while self.calls and self.calls[0][0] < now - app.config['BREAKER_WINDOW_SECONDS']:
+                self.calls.popleft()
+
+            if self.state == self.CLOSED and len(self.calls) >= app.config['BREAKER_MIN_CALLS']:
+                error_rate = sum(call[1] for call in self.calls) / len(self.calls)
+                slow_rate = sum(call[2] for call in self.calls) / len(self.calls)
+                if error_rate >= app.config['BREAKER_ERROR_RATE'] or slow_rate >= app.config['BREAKER_SLOW_CALL_RATE']:
+                    self.transition(self.OPEN)
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            statsd_client.incr(f'breaker.{self.name}.rejected')
+            if metrics is not None:
+                metrics.breaker_rejections.labels(self.name).inc()
+            raise CircuitOpenError(self.name)
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.record(is_dependency_failure(e), time.perf_counter() - start)
+            raise
+        self.record(False, time.perf_counter() - start)
+        return result
+
+    def snapshot(self):
+        with self.lock:
+            failures = sum(call[1] for call in self.calls)
+            return {
+                'state': self.state,
+                'calls': len(self.calls),
+                'error_rate': round(failures / len(self.calls), 3) if self.calls else 0.0
+            }
+
+breakers = {name: CircuitBreaker(name) for name in ('s3', 'sns', 'cloudwatch')}
+
+def retry_after_seconds(name):
+    breaker = breakers[name]
+    remaining = app.config['BREAKER_OPEN_SECONDS'] - (time.monotonic() - breaker.opened_at)
+    return max(1, int(remaining + 0.999))
+
+def guard_with_breaker(breaker, func):
+    @wraps(func)
+    def guarded(*args, **kwargs):
+        return breaker.call(func, *args, **kwargs)
+    return guarded
+
+aws_client_config = BotoConfig(
+    connect_timeout=app.config['AWS_CONNECT_TIMEOUT_SECONDS'],
+    read_timeout=app.config['AWS_READ_TIMEOUT_SECONDS'],
+    retries={'max_attempts': app.config['AWS_MAX_ATTEMPTS'], 'mode': 'standard'}
+)
+
 # Initialize AWS services only if not in testing mode
 
 sns_client = None
@@ -88,13 +593,16 @@ SNS_TOPIC_ARN = None
 if not TESTING:
     try:
         # Initialize AWS clients
-        logs_client = boto3.client('logs', region_name=app.config['AWS_REGION'])
-        s3_client = boto3.client('s3', region_name=app.config['AWS_REGION'])
+        logs_client = boto3.client('logs', region_name=app.config['AWS_REGION'], config=aws_client_config)
+        s3_client = boto3.client('s3', region_name=app.config['AWS_REGION'], config=aws_client_config)
         
         # SNS Client initialization
-        sns_client = boto3.client('sns', region_name=app.config['AWS_REGION'])
+        sns_client = boto3.client('sns', region_name=app.config['AWS_REGION'], config=aws_client_config)
         SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN')
         
+        # watchtower drops the batch and carries on when put_log_events raises, so an open breaker just sheds logs
+        logs_client.put_log_events = guard_with_breaker(breakers['cloudwatch'], logs_client.put_log_events)
+
         # Configure CloudWatch logging
         cloudwatch_handler = watchtower.CloudWatchLogHandler(
             log_group='csye6225',
@@ -111,6 +619,140 @@ else:
     s3_client = None
     SNS_TOPIC_ARN = None
 
+class S3Storage:
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def url(self, key):
+        return f"{self.bucket}/{key}"
+
+    def put(self, key, fileobj, content_type):
+        breakers['s3'].call(
+            self.client.upload_fileobj,
+            fileobj,
+            self.bucket,
+            key,
+            ExtraArgs={
+                'ContentType': content_type,
+                'ACL': 'private'
+            }
+        )
+
+    def delete(self, key):
+        breakers['s3'].call(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    def delete_prefix(self, prefix):
+        deleted = 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = iter(paginator.paginate(Bucket=self.bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}))
+        # Pages hold at most 1000 keys, the DeleteObjects limit
+        while True:
+            page = breakers['s3'].call(next, pages, None)
+            if page is None:
+                break
+            keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if not keys:
+                continue
+            response = breakers['s3'].call(
+                self.client.delete_objects, Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+            if response.get('Errors'):
+                raise RuntimeError(f"{len(response['Errors'])} objects under {prefix} could not be deleted")
+            deleted += len(keys)
+        return deleted
+
+    def send(self, key, mimetype):
+        # Clients download straight from S3 so the bytes never pass through the worker
+        return redirect(self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': key},
+            ExpiresIn=app.config['STORAGE_URL_EXPIRY_SECONDS']
+        ))
+
+class LocalFileStorage:
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Storage key escapes the storage root: {key}")
+        return path
+
+    def url(self, key):
+        return f"local/{key}"
+
+    def put(self, key, fileobj, content_type):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write beside the target and rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                shutil.copyfileobj(fileobj, tmp)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix):
+        # Prefixes are either one object or a directory, so only that part of the tree is touched
+        path = self.path(prefix)
+        if os.path.isfile(path):
+            os.remove(path)
+            return 1
+        deleted = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                os.remove(os.path.join(dirpath, filename))
+                deleted += 1
+        return deleted
+
+    def send(self, key, mimetype):
+        # send_file hands the open file to wsgi.file_wrapper (sendfile under gunicorn) and answers Range requests
+        return send_file(self.path(key), mimetype=mimetype, conditional=True)
+
+class MemoryStorage:
+    def __init__(self):
+        self.objects = {}
+
+    def url(self, key):
+        return f"memory/{key}"
+
+    def put(self, key, fileobj, content_type):
+        self.objects[key] = (fileobj.read(), content_type)
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        keys = [key for key in self.objects if key.startswith(prefix)]
+        for key in keys:
+            del self.objects[key]
+        return len(keys)
+
+    def send(self, key, mimetype):
+        data, _ = self.objects[key]
+        return send_file(io.BytesIO(data), mimetype=mimetype, conditional=True)
+
+def create_storage(backend):
+    if backend == 's3':
+        return S3Storage(s3_client, app.config['AWS_BUCKET_NAME'])
+    if backend == 'local':
+        return LocalFileStorage(app.config['STORAGE_LOCAL_ROOT'])
+    if backend == 'memory':
+        return MemoryStorage()
+    raise EnvironmentError(f"Unknown STORAGE_BACKEND: {backend}")
+
+storage = create_storage(app.config['STORAGE_BACKEND'])
+
 def verify_database():
     try:
         with statsd_client.timer('database.connection.timing'):
@@ -123,6 +765,33 @@ def verify_database():
         statsd_client.incr('database.connection.error')
         return False
 
+@contextmanager
+def timed_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            phases = g.setdefault('phase_timings', {})
+            phases[name] = phases.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_start_time = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - context.query_start_time) * 1000
+    route = 'background'
+    if has_request_context():
+        g.db_query_count = g.get('db_query_count', 0) + 1
+        g.db_time_ms = g.get('db_time_ms', 0.0) + elapsed_ms
+        route = request.url_rule.rule if request.url_rule else request.path
+
+    if elapsed_ms >= app.config['SLOW_QUERY_THRESHOLD_MS']:
+        statsd_client.incr('database.query.slow')
+        logger.warning(f"Slow query ({elapsed_ms:.1f}ms) on {route}: {statement}")
+
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.String(36), primary_key=True)
@@ -133,15 +802,25 @@ class User(db.Model):
     account_created = db.Column(db.DateTime, default=datetime.utcnow)
     account_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_verified = db.Column(db.Boolean, default=False)
-    verification_token = db.Column(db.String(100))
-    token_expiry = db.Column(db.DateTime)
+    # SHA-256 hex digest; 100 wide so unexpired legacy user_id + SECRET_TOKEN values still fit
+    verification_token = db.Column(db.String(100), index=True)
+    token_expiry = db.Column(db.DateTime, index=True)
     images = db.relationship('Image', backref='user', lazy=True, cascade="all, delete-orphan")
+    # The /pic routes only see the profile picture, never gallery images
+    profile_images = db.relationship('Image', primaryjoin="and_(User.id == Image.user_id, Image.is_profile == True)",
+                                     lazy=True, viewonly=True)
+    __table_args__ = (
+        # Keyset pagination for the admin listing and export
+        db.Index('ix_user_account_created_id', 'account_created', 'id'),
+    )
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        with timed_phase('hash'):
+            self.password_hash = generate_password_hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        with timed_phase('hash'):
+            return check_password_hash(self.password_hash, password)
 
 class Image(db.Model):
     __tablename__ = 'image'
@@ -150,46 +829,647 @@ class Image(db.Model):
     url = db.Column(db.String(512), nullable=False)
     upload_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    # SHA-256 of the bytes; images sharing a hash share one stored blob
+    content_hash = db.Column(db.String(64), index=True)
+    # False for gallery images uploaded through /v1/user/self/images
+    is_profile = db.Column(db.Boolean, nullable=False, default=True, server_default=text('1'))
+    __table_args__ = (
+        # Profile picture lookup, gallery keyset pagination and the user_id foreign key
+        db.Index('ix_image_user_id_is_profile_upload_date_id', 'user_id', 'is_profile', 'upload_date', 'id'),
+    )
+
+class Blob(db.Model):
+    # One row per stored blob, on the primary database even when users are sharded
+    __tablename__ = 'blob'
+    content_hash = db.Column(db.String(64), primary_key=True)
+    # Image rows pointing at the blob; changed in the same transaction as the insert or delete
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+EMAIL_PATTERN = re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$')
+
+class StorageCleanupTask(db.Model):
+    __tablename__ = 'storage_cleanup_task'
+    id = db.Column(db.String(36), primary_key=True)
+    prefix = db.Column(db.String(512), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(512))
+
+class PendingNotification(db.Model):
+    __tablename__ = 'pending_notification'
+    id = db.Column(db.String(36), primary_key=True)
+    topic_arn = db.Column(db.String(256), nullable=False)
+    # The message and its token are built at delivery time, so no usable link is stored
+    user_id = db.Column(db.String(36), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyRecord(db.Model):
+    __tablename__ = 'idempotency_record'
+    # SHA-256 of endpoint, caller and the client's Idempotency-Key
+    key = db.Column(db.String(64), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    # Null while the first request is still running
+    status_code = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    response_body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
 
 def validate_email(email):
-    pattern = r'^[\w\.-]+@[\w\.-]+\.\w+$'
-    return re.match(pattern, email) is not None
+    return isinstance(email, str) and EMAIL_PATTERN.match(email) is not None
 
 def validate_name(name):
-    return name.isalpha()
+    return isinstance(name, str) and name.isalpha()
 
 def validate_password(password):
-    return len(password) >= 8
+    return isinstance(password, str) and len(password) >= 8
+
+# Field -> (validator, error key reported to statsd)
+USER_CREATE_SCHEMA = {
+    'first_name': (validate_name, 'invalid_name'),
+    'last_name': (validate_name, 'invalid_name'),
+    'email': (validate_email, 'invalid_email'),
+    'password': (validate_password, 'invalid_password')
+}
+
+USER_UPDATE_SCHEMA = {
+    'first_name': (validate_name, 'invalid_name'),
+    'last_name': (validate_name, 'invalid_name'),
+    'password': (validate_password, 'invalid_password')
+}
+
+def validate_payload(data, schema):
+    if not isinstance(data, dict) or not data:
+        return 'no_data'
+    if not schema.keys() <= data.keys():
+        return 'missing_fields'
+    for field, (validator, error) in schema.items():
+        if not validator(data[field]):
+            return error
+    return None
+
+def serialize_user(user):
+    return {
+        "id": user.id,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "email": user.email,
+        "account_created": user.account_created.isoformat(),
+        "account_updated": user.account_updated.isoformat()
+    }
+
+def serialize_admin_user(user):
+    return {**serialize_user(user), "is_verified": bool(user.is_verified)}
+
+def encode_cursor(timestamp, row_id):
+    raw = json.dumps([timestamp.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(decoded, list) and len(decoded) == 2 and all(isinstance(part, str) for part in decoded)):
+        raise ValueError(f"Malformed cursor: {cursor}")
+    timestamp, row_id = decoded
+    return datetime.fromisoformat(timestamp), row_id
+
+def serialize_image(image):
+    return {
+        "file_name": image.file_name,
+        "id": image.id,
+        "url": image.url,
+        "upload_date": image.upload_date.strftime("%Y-%m-%d"),
+        "user_id": image.user_id
+    }
+
+def generate_verification_token():
+    return secrets.token_urlsafe(32)
+
+def hash_token(token):
+    # Only the digest is stored, so a leaked table does not leak usable links
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def stored_token_values(token):
+    # Legacy rows hold the user_id + SECRET_TOKEN link value itself rather than a digest
+    values = [hash_token(token)]
+    secret = app.config['SECRET_TOKEN']
+    if secret and len(token) > len(secret) and token.endswith(secret):
+        values.append(token)
+    return values
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def profile_pic_key(user_id, filename):
+    return f"{user_id}/profile.{filename.rsplit('.', 1)[1].lower()}"
+
+BLOB_PREFIX = 'blobs/'
+
+def blob_key(content_hash):
+    return f"{BLOB_PREFIX}{content_hash}"
+
+def image_storage_key(image):
+    if image.content_hash:
+        return blob_key(image.content_hash)
+    return profile_pic_key(image.user_id, image.file_name)
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+)
+
+def sniff_image_type(head):
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    return None
+
+def upload_digest(file):
+    stream = file.stream
+    if isinstance(stream, HashingFile):
+        return stream.sha256.hexdigest(), stream.head
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    head = stream.read(UPLOAD_SNIFF_BYTES)
+    stream.seek(0)
+    return digest.hexdigest(), head
+
+def blob_reference_count(content_hash):
+    # Blobs are shared across shards, so every shard's image table can hold a reference
+    references = 0
+    for shard in range(shard_router.count):
+        with use_shard(shard):
+            references += Image.query.filter_by(content_hash=content_hash).count()
+    return references
+
+gallery_upload_pool = ThreadPoolExecutor(app.config['GALLERY_UPLOAD_WORKERS'], thread_name_prefix='gallery_upload')
+
+def put_blobs(missing, metric_prefix):
+    # missing: content_hash -> (file, mimetype); returns the blob keys written before any failure
+    if len(missing) == 1:
+        # A single blob is written inline rather than queued behind gallery batches
+        pending = dict.fromkeys(missing)
+    else:
+        pending = {content_hash: gallery_upload_pool.submit(storage.put, blob_key(content_hash), file, mimetype)
+                   for content_hash, (file, mimetype) in missing.items()}
+
+    stored, error = [], None
+    with statsd_client.timer(f'{metric_prefix}.storage.timing'), timed_phase('storage'):
+        for content_hash, future in pending.items():
+            try:
+                if future is None:
+                    storage.put(blob_key(content_hash), *missing[content_hash])
+                else:
+                    future.result()
+                stored.append(blob_key(content_hash))
+            except Exception as e:
+                error = error or e
+    statsd_client.incr(f'{metric_prefix}.storage.success', len(stored))
+    return stored, error
+
+def store_uploads(uploads, metric_prefix):
+    # uploads: (file, content_hash, mimetype). Takes a reference on each blob in the caller's
+    # transaction, which must commit the Image rows; identical bytes are stored once.
+    # Returns the blob keys this call wrote, for discard_new_blobs if that commit fails
+    counts = {}
+    for file, content_hash, mimetype in uploads:
+        counts[content_hash] = counts.get(content_hash, 0) + 1
+
+    written = []
+    try:
+        for attempt in range(2):
+            # The row lock keeps the cleanup worker from deleting a blob we are about to reference
+            blobs = {blob.content_hash: blob for blob in
+                     Blob.query.filter(Blob.content_hash.in_(counts)).with_for_update().all()}
+            missing = {content_hash: (file, mimetype) for file, content_hash, mimetype in uploads
+                       if content_hash not in blobs}
+            if len(missing) < len(uploads):
+                statsd_client.incr(f'{metric_prefix}.storage.dedup_hit', len(uploads) - len(missing))
+
+            if missing:
+                stored, error = put_blobs(missing, metric_prefix)
+                written.extend(stored)
+                if error is not None:
+                    raise error
+
+            for content_hash, count in counts.items():
+                if content_hash in blobs:
+                    blobs[content_hash].refcount += count
+                else:
+                    db.session.add(Blob(content_hash=content_hash, refcount=count))
+            try:
+                db.session.flush()
+                return written
+            except exc.IntegrityError:
+                # A concurrent upload of the same bytes created the row first; take a reference on it
+                db.session.rollback()
+                if attempt:
+                    raise
+    except Exception:
+        db.session.rollback()
+        discard_new_blobs(written)
+        raise
+
+def discard_new_blobs(keys):
+    # The request failed after writing these blobs, so no Image row will reference them; the caller has rolled back
+    if not keys:
+        return
+    try:
+        enqueue_blob_cleanup(keys)
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Could not queue cleanup of {len(keys)} new blobs: {str(e)}")
+        db.session.rollback()
+
+def enqueue_blob_cleanup(keys):
+    # The grace period covers an upload that has written a blob but not yet committed its row
+    due = datetime.utcnow() + timedelta(seconds=app.config['BLOB_CLEANUP_GRACE_SECONDS'])
+    for key in keys:
+        db.session.add(StorageCleanupTask(id=str(uuid.uuid4()), prefix=key, next_attempt_at=due))
+
+def release_blobs(images):
+    # Drops the references held by images deleted in the same transaction
+    counts = {}
+    for image in images:
+        if image.content_hash:
+            counts[image.content_hash] = counts.get(image.content_hash, 0) + 1
+    if not counts:
+        return
+
+    blobs = Blob.query.filter(Blob.content_hash.in_(counts)).with_for_update().all()
+    for blob in blobs:
+        blob.refcount = max(blob.refcount - counts[blob.content_hash], 0)
+    # Blobs stored before reference counting have no row; the worker recounts those
+    counted = {blob.content_hash for blob in blobs if blob.refcount > 0}
+    enqueue_blob_cleanup(blob_key(content_hash) for content_hash in counts if content_hash not in counted)
+
+def reclaim_blob(content_hash):
+    # Deletes the blob if nothing references it; returns the objects deleted, or None if it is in use.
+    # The row stays locked until the caller commits, so no upload can take a reference meanwhile
+    blob = db.session.get(Blob, content_hash, with_for_update=True)
+    if blob is not None and blob.refcount > 0:
+        return None
+
+    references = blob_reference_count(content_hash)
+    if references:
+        # Images written before reference counting existed; adopt them into the count
+        if blob is None:
+            db.session.add(Blob(content_hash=content_hash, refcount=references))
+        else:
+            blob.refcount = references
+        return None
+
+    if blob is not None:
+        db.session.delete(blob)
+        db.session.flush()
+    return storage.delete_prefix(blob_key(content_hash))
+
+def image_mimetype(filename):
+    return f"image/{filename.rsplit('.', 1)[1].lower()}"
+
+class DatabaseUnavailable(Exception):
+    pass
+
+degraded_mode = threading.Event()
+
+# Routes that keep working from the cache while the database is down; health probes stay so recovery is noticed
+DEGRADED_ENDPOINTS = {'get_user', 'get_profile_pic', 'download_profile_pic', 'health_check', 'health_check2', 'readiness_check', 'prometheus_metrics'}
+
+def set_degraded(active):
+    if active == degraded_mode.is_set():
+        return
+    if active:
+        degraded_mode.set()
+        logger.error("Database unavailable, entering degraded read-only mode")
+    else:
+        degraded_mode.clear()
+        logger.info("Database available, leaving degraded read-only mode")
+    statsd_client.gauge('degraded.active', int(active))
+
+class CachedImage:
+    __slots__ = ('id', 'file_name', 'url', 'upload_date', 'user_id', 'content_hash')
+
+    def __init__(self, image):
+        for field in self.__slots__:
+            setattr(self, field, getattr(image, field))
+
+class CachedUser:
+    __slots__ = ('id', 'first_name', 'last_name', 'email', 'account_created', 'account_updated', 'is_verified', 'profile_images')
+
+    def __init__(self, user, images):
+        for field in self.__slots__[:-1]:
+            setattr(self, field, getattr(user, field))
+        self.profile_images = images
+
+class UserCache:
+    # Recent users and a keyed digest of the password they authenticated with; passwords are never stored
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.key = secrets.token_bytes(32)
+
+    def digest(self, email, password):
+        return hmac.new(self.key, f"{email}\0{password}".encode(), hashlib.sha256).digest()
+
+    @property
+    def enabled(self):
+        return app.config['DEGRADED_CACHE_ENABLED'] and app.config['DEGRADED_CACHE_SIZE'] > 0
+
+    def remember(self, email, password, user):
+        if not self.enabled:
+            return
+        images = None
+        if isinstance(user, User) and 'profile_images' in sa_inspect(user).dict:
+            images = [CachedImage(image) for image in user.profile_images]
+        with self.lock:
+            previous = self.entries.pop(email, None)
+            if images is None and previous:
+                images = previous[1].profile_images
+            expires_at = time.monotonic() + app.config['DEGRADED_CACHE_TTL_SECONDS']
+            self.entries[email] = (self.digest(email, password), CachedUser(user, images), expires_at)
+            while len(self.entries) > app.config['DEGRADED_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def verify(self, email, password):
+        with self.lock:
+            entry = self.entries.get(email)
+        if entry is None or entry[2] < time.monotonic():
+            return None
+        if not hmac.compare_digest(entry[0], self.digest(email, password)):
+            return None
+        return entry[1]
+
+    def forget(self, email):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries.pop(email, None)
+
+user_cache = UserCache()
+
+class EmailBloomFilter:
+    # Can say "maybe registered" for a new email (false positive or deleted account), never the reverse
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.lock = threading.Lock()
+
+    def positions(self, email):
+        digest = hashlib.sha256(email.encode()).digest()
+        first, second = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:16], 'big')
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, email):
+        with self.lock:
+            for position in self.positions(email):
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, email):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(email))
+
+email_filter = None
+if app.config['EMAIL_BLOOM_FILTER_ENABLED']:
+    email_filter = EmailBloomFilter(app.config['EMAIL_BLOOM_FILTER_CAPACITY'],
+                                    app.config['EMAIL_BLOOM_FILTER_ERROR_RATE'])
+
+def warm_email_filter():
+    if email_filter is None:
+        return 0
+    warmed = 0
+    for _ in each_shard():
+        for email in db.session.execute(select(User.email).execution_options(yield_per=10000)).scalars():
+            email_filter.add(email)
+            warmed += 1
+    statsd_client.gauge('signup.email_filter.size', warmed)
+    logger.info(f"Loaded {warmed} emails into the signup Bloom filter")
+    return warmed
+
+def email_registered(email):
+    # Only a filter hit costs a lookup; a miss goes straight to the insert, which the unique index guards
+    if email_filter is None or email not in email_filter:
+        return False
+    statsd_client.incr('signup.email_filter.hit')
+    return db.session.query(User.id).filter_by(email=email).first() is not None
+
+PICTURE_ENDPOINTS = {'upload_profile_pic', 'get_profile_pic', 'download_profile_pic', 'delete_profile_pic'}
+
 @auth.verify_password
 def verify_password(email, password):
+    with timed_phase('auth'):
+        return authenticate(email, password)
+
+def authenticate(email, password):
     statsd_client.incr('auth.attempt')
     if not email or not password:
         statsd_client.incr('auth.invalid_input')
         return None
     if not validate_email(email):
         return None
-    user = User.query.filter_by(email=email).first()
+    if degraded_mode.is_set():
+        return authenticate_from_cache(email, password)
+    if request.endpoint in PICTURE_ENDPOINTS:
+        # Picture routes need the user's image, so fetch it with the user in one round trip
+        query = User.query.options(joinedload(User.profile_images))
+    else:
+        query = db.session.query(*AUTH_COLUMNS)
+    g.db_shard = shard_router.shard_for_email(email)
+    user = query.filter_by(email=email).first()
+    if user is None:
+        user = find_on_previous_shard(email, query.filter_by(email=email))
+    if isinstance(user, Row):
+        user = AuthPrincipal(user)
     if user and user.check_password(password):
         statsd_client.incr('auth.success')
+        user_cache.remember(email, password, user)
         return user
     statsd_client.incr('auth.failure')
     return None
 
+AUTH_COLUMNS = (User.id, User.first_name, User.last_name, User.email, User.account_created,
+                User.account_updated, User.is_verified, User.password_hash)
+
+class AuthPrincipal:
+    # Authenticated user from a column projection: no identity map entry, no change tracking.
+    # Carries the profile columns so read routes never need the entity.
+    __slots__ = tuple(column.key for column in AUTH_COLUMNS) + ('user',)
+
+    def __init__(self, row):
+        for column in AUTH_COLUMNS:
+            setattr(self, column.key, getattr(row, column.key))
+        self.user = None
+
+    def check_password(self, password):
+        with timed_phase('hash'):
+            return check_password_hash(self.password_hash, password)
+
+    def entity(self):
+        if self.user is None:
+            statsd_client.incr('auth.principal.upgrade')
+            self.user = db.session.get(User, self.id)
+        return self.user
+
+def current_user_entity():
+    # Routes that modify or delete the user work on the mapped User
+    user = auth.current_user()
+    return user.entity() if isinstance(user, AuthPrincipal) else user
+
+def current_profile_image():
+    images = current_user_entity().profile_images
+    if images is None:
+        # Cached from a route that did not load pictures, so "no picture" cannot be told from "unknown"
+        statsd_client.incr('degraded.picture_unknown')
+        raise DatabaseUnavailable()
+    return next(iter(images), None)
+
+def find_on_previous_shard(email, query):
+    # Only while a rebalance is pending can a user still live where their email used to hash
+    shard = shard_router.previous_shard_for_email(email)
+    if shard is None:
+        return None
+    with use_shard(shard):
+        user = query.first()
+    if user is not None:
+        statsd_client.incr('database.shard.fallback_hit')
+        g.db_shard = shard
+    return user
+
+def authenticate_from_cache(email, password):
+    cached_user = user_cache.verify(email, password)
+    if cached_user is None:
+        # The database cannot say whether these credentials are wrong, so do not answer 401
+        statsd_client.incr('auth.degraded.miss')
+        raise DatabaseUnavailable()
+    statsd_client.incr('auth.degraded.hit')
+    return cached_user
+
 def check_queryparam():
     return bool(request.args)
 
 def check_db_connection():
     try:
         db.session.execute(text('SELECT 1'))
+        if replica_pool.engines:
+            replica_pool.probe()
+        set_degraded(False)
         return True
     except Exception:
         logger.error("Database connection failed")
+        db.session.rollback()
+        set_degraded(True)
         return False
 
+@admin_auth.verify_token
+def verify_admin_token(token):
+    expected = app.config['ADMIN_API_TOKEN']
+    if expected and token and hmac.compare_digest(token, expected):
+        return 'admin'
+    statsd_client.incr('auth.admin.failure')
+    return None
+
+def request_fingerprint():
+    digest = hashlib.sha256(f"{request.method} {request.path}".encode())
+    if request.files:
+        # Uploads were already hashed while being received, so avoid buffering them again
+        for name, file in sorted(request.files.items(multi=True)):
+            digest.update(f"{name}:{file.filename}:{upload_digest(file)[0]}".encode())
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f"{name}={value}".encode())
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+def claim_idempotency_key(key, fingerprint):
+    now = datetime.utcnow()
+    record = db.session.get(IdempotencyRecord, key, populate_existing=True)
+    if record is not None:
+        lock_expired = record.status_code is None and \
+            record.created_at < now - timedelta(seconds=app.config['IDEMPOTENCY_LOCK_TIMEOUT_SECONDS'])
+        if record.expires_at > now and not lock_expired:
+            return record
+        db.session.delete(record)
+        db.session.flush()
+
+    db.session.add(IdempotencyRecord(
+        key=key,
+        request_hash=fingerprint,
+        created_at=now,
+        expires_at=now + timedelta(seconds=app.config['IDEMPOTENCY_TTL_SECONDS'])
+    ))
+    try:
+        db.session.commit()
+        return None
+    except exc.IntegrityError:
+        # Lost the race to another request carrying the same key
+        db.session.rollback()
+        return db.session.get(IdempotencyRecord, key, populate_existing=True)
+
+def replay_idempotent_response(record):
+    response = app.response_class(record.response_body, status=record.status_code, content_type=record.content_type)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return f(*args, **kwargs)
+        if len(client_key) > 255:
+            statsd_client.incr('idempotency.error.invalid_key')
+            return '', 400
+
+        caller = request.authorization.username if request.authorization else ''
+        key = hashlib.sha256(f"{request.endpoint}:{caller}:{client_key}".encode()).hexdigest()
+        fingerprint = request_fingerprint()
+        deadline = time.monotonic() + app.config['IDEMPOTENCY_WAIT_SECONDS']
+
+        while True:
+            record = claim_idempotency_key(key, fingerprint)
+            if record is None:
+                break
+            if record.request_hash != fingerprint:
+                statsd_client.incr('idempotency.error.mismatch')
+                return '', 422
+            if record.status_code is not None:
+                statsd_client.incr('idempotency.replay')
+                return replay_idempotent_response(record)
+            # The first request is still running; wait for its result instead of repeating the work
+            if time.monotonic() >= deadline:
+                statsd_client.incr('idempotency.error.in_flight')
+                return '', 409
+            statsd_client.incr('idempotency.wait')
+            db.session.rollback()
+            time.sleep(0.05)
+
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(key)
+            raise
+
+        if response.status_code >= 500 or response.is_streamed:
+            # Failed attempts are not remembered so the client can retry them
+            release_idempotency_key(key)
+            return response
+
+        record = db.session.get(IdempotencyRecord, key)
+        record.status_code = response.status_code
+        record.content_type = response.content_type
+        record.response_body = response.get_data()
+        db.session.commit()
+        return response
+    return decorated_function
+
+def release_idempotency_key(key):
+    db.session.rollback()
+    IdempotencyRecord.query.filter_by(key=key, status_code=None).delete()
+    db.session.commit()
+
 def require_verification(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -260,7 +1540,51 @@ def health_check2():
             statsd_client.incr('endpoint.healthcheck.error')
             return '', 503
 
+def verification_message(user, token):
+    return json.dumps({
+        'user_id': user.id,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'token': token
+    })
+
+def publish_verification(user, token):
+    try:
+        with timed_phase('sns'):
+            breakers['sns'].call(sns_client.publish, TopicArn=SNS_TOPIC_ARN, Message=verification_message(user, token))
+    except Exception as e:
+        # Queue the user for the notification worker instead of dropping the email or waiting on SNS
+        logger.warning(f"Deferring SNS publish: {str(e)}")
+        statsd_client.incr('sns.deferred')
+        try:
+            db.session.add(PendingNotification(id=str(uuid.uuid4()), topic_arn=SNS_TOPIC_ARN, user_id=user.id))
+            db.session.commit()
+        except Exception as db_error:
+            logger.error(f"SNS publish error: {str(db_error)}")
+            db.session.rollback()
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    statsd_client.incr('endpoint.readiness.attempt')
+    db_healthy = check_db_connection()
+    breaker_states = {name: breaker.snapshot() for name, breaker in breakers.items()}
+    for name, snapshot in breaker_states.items():
+        statsd_client.gauge(f'breaker.{name}.state', CircuitBreaker.STATE_VALUES[snapshot['state']])
+
+    return jsonify({
+        'database': 'ok' if db_healthy else 'unavailable',
+        'dependencies': breaker_states
+    }), 200 if db_healthy else 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if metrics is None:
+        return '', 404
+    return app.response_class(metrics.render(), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
 @app.route('/v1/user', methods=['POST'])
+@idempotent
 def create_user():
     logger.info("POST /v1/user - Create user request received")
     statsd_client.incr('endpoint.user.create.attempt')
@@ -269,75 +1593,52 @@ def create_user():
             return '', 404
 
         data = request.json
-        if not data:
+        if validate_payload(data, USER_CREATE_SCHEMA):
             return '', 400
 
-        required_keys = ('first_name', 'last_name', 'email', 'password')
-        if not all(key in data for key in required_keys):
+        g.db_shard = shard_router.shard_for_email(data['email'])
+        if email_registered(data['email']):
+            statsd_client.incr('endpoint.user.create.duplicate')
             return '', 400
-
-        if not validate_name(data['first_name']) or not validate_name(data['last_name']):
-            return '', 400
-
-        if not validate_email(data['email']):
-            return '', 400
-
-        if not validate_password(data['password']):
-            return '', 400
-
-        if User.query.filter_by(email=data['email']).first():
+        # The unique index only covers the home shard; users not yet moved by rebalance-shards live elsewhere
+        if find_on_previous_shard(data['email'], db.session.query(User.id).filter_by(email=data['email'])) is not None:
+            statsd_client.incr('endpoint.user.create.duplicate')
             return '', 400
 
+        verification_token = generate_verification_token()
+        account_created = datetime.utcnow()
         new_user = User(
             id=str(uuid.uuid4()),
             first_name=data['first_name'],
             last_name=data['last_name'],
             email=data['email'],
-            is_verified=False
+            is_verified=False,
+            account_created=account_created,
+            account_updated=account_created,
+            verification_token=hash_token(verification_token),
+            token_expiry=account_created + timedelta(minutes=app.config['VERIFICATION_TOKEN_TTL_MINUTES'])
         )
-        new_user.set_password(data['password'])
-        db.session.add(new_user)
-        db.session.commit()
+        try:
+            new_user.set_password(data['password'])
+            db.session.add(new_user)
+            db.session.commit()
+        except exc.IntegrityError:
+            # The unique index on email is the duplicate check
+            db.session.rollback()
+            statsd_client.incr('endpoint.user.create.duplicate')
+            return '', 400
+        if email_filter is not None:
+            email_filter.add(new_user.email)
         
         statsd_client.incr('endpoint.user.create.success')
         
-        secret_token = os.getenv('SECRET_TOKEN')  # Get the SECRET_TOKEN from .env
-        token_data = new_user.id + secret_token
-        
-        verification_token = token_data
-        
-        new_user.verification_token = verification_token
-        new_user.token_expiry = new_user.account_created + timedelta(minutes=2)
-        db.session.commit()
-        
          # Publish to SNS if not in testing mode
         if not TESTING  and sns_client and SNS_TOPIC_ARN:
-            try:
-                sns_message = {
-                    'user_id': new_user.id,
-                    'email': new_user.email,
-                    'first_name': new_user.first_name,
-                    'last_name': new_user.last_name
-                }
-                sns_client.publish(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Message=json.dumps(sns_message)
-                )
-            except Exception as e:
-                logger.error(f"SNS publish error: {str(e)}")
+            publish_verification(new_user, verification_token)
 
-        # Update User model to include verification status
-        new_user.is_verified = False
-        db.session.commit()
-        
-        return jsonify({
-            "id": new_user.id,
-            "first_name": new_user.first_name,
-            "last_name": new_user.last_name,
-            "email": new_user.email,
-            "account_created": new_user.account_created.isoformat(),
-            "account_updated": new_user.account_updated.isoformat()
-        }), 201
+        with timed_phase('serialize'):
+            body = jsonify(serialize_user(new_user))
+        return body, 201
     except Exception as e:
         logger.error(f"Error creating user: {str(e)}")
         statsd_client.incr('endpoint.user.create.error')
@@ -351,7 +1652,15 @@ def verify_user():
         if not token:
             return '', 400
 
-        user = User.query.filter_by(verification_token=token).first()
+        # The token does not say which shard issued it, so ask each one
+        token_values = stored_token_values(token)
+        user = None
+        for shard in range(shard_router.count):
+            with use_shard(shard):
+                user = User.query.filter(User.verification_token.in_(token_values)).first()
+            if user:
+                g.db_shard = shard
+                break
         if not user:
             return '', 400
 
@@ -361,9 +1670,13 @@ def verify_user():
         if datetime.utcnow() > user.token_expiry:
             return '', 400
 
+        if user.verification_token == token and token != user.id + app.config['SECRET_TOKEN']:
+            return '', 400
+
         user.is_verified = True
         user.verification_token = None  # Nullify the token after use
         db.session.commit()
+        mark_recent_write(user.email)
 
         return '', 200
     except Exception as e:
@@ -382,27 +1695,15 @@ def update_user():
             statsd_client.incr('endpoint.user.update.error.query_param')
             return '', 404
 
-        user = auth.current_user()
         data = request.json
 
-        if not data:
-            statsd_client.incr('endpoint.user.update.error.no_data')
-            return '', 400
-
-        required_fields = ['first_name', 'last_name', 'password']
-        if not all(field in data for field in required_fields):
-            statsd_client.incr('endpoint.user.update.error.missing_fields')
-            return '', 400
-
-        if not validate_name(data['first_name']) or not validate_name(data['last_name']):
-            statsd_client.incr('endpoint.user.update.error.invalid_name')
-            return '', 400
-
-        if not validate_password(data['password']):
-            statsd_client.incr('endpoint.user.update.error.invalid_password')
+        error = validate_payload(data, USER_UPDATE_SCHEMA)
+        if error:
+            statsd_client.incr(f'endpoint.user.update.error.{error}')
             return '', 400
 
         try:
+            user = current_user_entity()
             user.first_name = data['first_name']
             user.last_name = data['last_name']
             user.set_password(data['password'])
@@ -411,14 +1712,9 @@ def update_user():
                 db.session.commit()
             
             statsd_client.incr('endpoint.user.update.success')
-            return jsonify({
-                "id": user.id,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "email": user.email,
-                "account_created": user.account_created.isoformat(),
-                "account_updated": user.account_updated.isoformat()
-            }), 200
+            with timed_phase('serialize'):
+                body = jsonify(serialize_user(user))
+            return body, 200
 
         except Exception as e:
             logger.error(f"Error updating user: {str(e)}")
@@ -445,21 +1741,46 @@ def get_user():
 
             user = auth.current_user()
             statsd_client.incr('endpoint.user.self.get.success')
-            return jsonify({
-                "id": user.id,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "email": user.email,
-                "account_created": user.account_created.isoformat(),
-                "account_updated": user.account_updated.isoformat()
-            }), 200
+            with timed_phase('serialize'):
+                body = jsonify(serialize_user(user))
+            return body, 200
         except Exception as e:
             statsd_client.incr('endpoint.user.self.get.error')
             return '',500
 
+@app.route('/v1/user/self', methods=['DELETE'])
+@auth.login_required
+@require_verification
+def delete_user():
+    logger.info("DELETE /v1/user/self - Delete user request received")
+    statsd_client.incr('endpoint.user.delete.attempt')
+
+    with statsd_client.timer('endpoint.user.delete.timing'):
+        if check_queryparam():
+            statsd_client.incr('endpoint.user.delete.error.query_param')
+            return '', 404
+
+        try:
+            user = current_user_entity()
+            # Rows go in one transaction; stored objects are removed later by the cleanup worker
+            release_blobs(user.images)
+            db.session.delete(user)
+            db.session.add(StorageCleanupTask(id=str(uuid.uuid4()), prefix=f"{user.id}/"))
+            db.session.commit()
+
+            statsd_client.incr('endpoint.user.delete.success')
+            return '', 204
+
+        except Exception as e:
+            logger.error(f"Error deleting user: {str(e)}")
+            statsd_client.incr('endpoint.user.delete.error')
+            db.session.rollback()
+            return '', 500
+
 @app.route('/v1/user/self/pic', methods=['POST'])
 @auth.login_required
 @require_verification
+@idempotent
 def upload_profile_pic():
     logger.info("POST /v1/user/self/pic - Upload profile picture request received")
     statsd_client.incr('endpoint.user.pic.upload.attempt')
@@ -483,55 +1804,54 @@ def upload_profile_pic():
             statsd_client.incr('endpoint.user.pic.upload.error.invalid_extension')
             return '', 400
 
+        content_hash, head = upload_digest(file)
+        mimetype = sniff_image_type(head)
+        if not mimetype:
+            statsd_client.incr('endpoint.user.pic.upload.error.invalid_content')
+            return '', 400
+
+        new_blobs = []
         try:
+            user = current_user_entity()
+            user_id = user.id
+
             # Check if user already has a profile picture
-            existing_image = Image.query.filter_by(user_id=auth.current_user().id).first()
-            if existing_image:
+            if user.profile_images:
                 statsd_client.incr('endpoint.user.pic.upload.error.already_exists')
-                logger.warning(f"User {auth.current_user().id} already has a profile picture")
+                logger.warning(f"User {user_id} already has a profile picture")
                 return '', 400  # Return 400 if user already has an image
 
-            user_id = auth.current_user().id
             original_filename = secure_filename(file.filename)
-            file_extension = original_filename.rsplit('.', 1)[1].lower()
-            s3_key = f"{user_id}/profile.{file_extension}"
-
-            if not TESTING:
-                with statsd_client.timer('endpoint.user.pic.upload.s3.timing'):
-                    s3_client.upload_fileobj(
-                        file,
-                        app.config['AWS_BUCKET_NAME'],
-                        s3_key,
-                        ExtraArgs={
-                            'ContentType': f'image/{file_extension}',
-                            'ACL': 'private'
-                        }
-                    )
-                statsd_client.incr('endpoint.user.pic.upload.s3.success')
+            new_blobs = store_uploads([(file, content_hash, mimetype)], 'endpoint.user.pic.upload')
+            storage_key = blob_key(content_hash)
 
             image = Image(
                 id=str(uuid.uuid4()),  # Generate a new UUID for the image
                 file_name=original_filename,
-                url=f"{app.config['AWS_BUCKET_NAME']}/{s3_key}",
-                user_id=user_id
+                url=storage.url(storage_key),
+                user_id=user_id,
+                content_hash=content_hash
             )
             
             db.session.add(image)
             db.session.commit()
             statsd_client.incr('endpoint.user.pic.upload.db.success')
 
-            return jsonify({
-                "file_name": image.file_name,
-                "id": image.id,
-                "url": image.url,
-                "upload_date": image.upload_date.strftime("%Y-%m-%d"),
-                "user_id": image.user_id
-            }), 201
+            with timed_phase('serialize'):
+                body = jsonify(serialize_image(image))
+            return body, 201
+
+        except CircuitOpenError as e:
+            statsd_client.incr('endpoint.user.pic.upload.error.circuit_open')
+            db.session.rollback()
+            discard_new_blobs(new_blobs)
+            return '', 503, {'Retry-After': str(retry_after_seconds(e.name))}
 
         except Exception as e:
             logger.error(f"Error uploading profile picture: {str(e)}")
             statsd_client.incr('endpoint.user.pic.upload.error')
             db.session.rollback()
+            discard_new_blobs(new_blobs)
             return '', 500
 
 @app.route('/v1/user/self/pic', methods=['GET'])
@@ -551,27 +1871,51 @@ def get_profile_pic():
             return '', 400
 
         try:
-            with statsd_client.timer('endpoint.user.pic.get.db.timing'):
-                image = Image.query.filter_by(user_id=auth.current_user().id).first()
+            image = current_profile_image()
             
             if not image:
                 statsd_client.incr('endpoint.user.pic.get.error.not_found')
                 return '', 404
 
             statsd_client.incr('endpoint.user.pic.get.success')
-            return jsonify({
-                "file_name": image.file_name,
-                "id": image.id,
-                "url": image.url,
-                "upload_date": image.upload_date.strftime("%Y-%m-%d"),
-                "user_id": image.user_id
-            }), 200
+            with timed_phase('serialize'):
+                body = jsonify(serialize_image(image))
+            return body, 200
+
+        except DatabaseUnavailable:
+            raise
 
         except Exception as e:
             logger.error(f"Error retrieving profile picture: {str(e)}")
             statsd_client.incr('endpoint.user.pic.get.error')
             return '', 500
 
+@app.route('/v1/user/self/pic/file', methods=['GET'])
+@auth.login_required
+@require_verification
+def download_profile_pic():
+    statsd_client.incr('endpoint.user.pic.download.attempt')
+
+    with statsd_client.timer('endpoint.user.pic.download.timing'):
+        if check_queryparam():
+            statsd_client.incr('endpoint.user.pic.download.error.query_param')
+            return '', 404
+
+        image = current_profile_image()
+        if not image:
+            statsd_client.incr('endpoint.user.pic.download.error.not_found')
+            return '', 404
+
+        try:
+            with timed_phase('storage'):
+                response = storage.send(image_storage_key(image), image_mimetype(image.file_name))
+        except (KeyError, FileNotFoundError):
+            statsd_client.incr('endpoint.user.pic.download.error.missing_object')
+            return '', 404
+
+        statsd_client.incr('endpoint.user.pic.download.success')
+        return response
+
 @app.route('/v1/user/self/pic', methods=['DELETE'])
 @auth.login_required
 @require_verification
@@ -585,27 +1929,28 @@ def delete_profile_pic():
             return '', 404
 
         try:
-            with statsd_client.timer('endpoint.user.pic.delete.db.query.timing'):
-                image = Image.query.filter_by(user_id=auth.current_user().id).first()
-            
+            user = current_user_entity()
+            image = next(iter(user.profile_images), None)
+
             if not image:
                 statsd_client.incr('endpoint.user.pic.delete.error.not_found')
                 return '', 404
 
-            if not TESTING:
+            if image.content_hash:
+                # Shared blobs are removed by the cleanup worker once nothing references them
+                release_blobs([image])
+            else:
                 try:
-                    file_extension = image.file_name.rsplit('.', 1)[1].lower()
-                    s3_key = f"{auth.current_user().id}/profile.{file_extension}"
-                    
-                    with statsd_client.timer('endpoint.user.pic.delete.s3.timing'):
-                        s3_client.delete_object(
-                            Bucket=app.config['AWS_BUCKET_NAME'],
-                            Key=s3_key
-                        )
-                    statsd_client.incr('endpoint.user.pic.delete.s3.success')
-                except ClientError as e:
-                    logger.error(f"Error deleting from S3: {str(e)}")
-                    statsd_client.incr('endpoint.user.pic.delete.s3.error')
+                    with statsd_client.timer('endpoint.user.pic.delete.storage.timing'), timed_phase('storage'):
+                        storage.delete(image_storage_key(image))
+                    statsd_client.incr('endpoint.user.pic.delete.storage.success')
+                except CircuitOpenError:
+                    # Leave the object to the cleanup worker rather than failing the request
+                    db.session.add(StorageCleanupTask(id=str(uuid.uuid4()), prefix=image_storage_key(image)))
+                    statsd_client.incr('endpoint.user.pic.delete.storage.deferred')
+                except (ClientError, OSError) as e:
+                    logger.error(f"Error deleting from storage: {str(e)}")
+                    statsd_client.incr('endpoint.user.pic.delete.storage.error')
 
             with statsd_client.timer('endpoint.user.pic.delete.db.delete.timing'):
                 db.session.delete(image)
@@ -620,6 +1965,505 @@ def delete_profile_pic():
             db.session.rollback()
             return '', 500
 
+@app.route('/v1/user/self/images', methods=['POST'])
+@auth.login_required
+@require_verification
+@idempotent
+def upload_gallery_images():
+    statsd_client.incr('endpoint.user.gallery.upload.attempt')
+
+    with statsd_client.timer('endpoint.user.gallery.upload.timing'):
+        if check_queryparam():
+            statsd_client.incr('endpoint.user.gallery.upload.error.query_param')
+            return '', 404
+
+        files = request.files.getlist('images')
+        if not files or len(files) > app.config['GALLERY_MAX_BATCH']:
+            statsd_client.incr('endpoint.user.gallery.upload.error.batch_size')
+            return '', 400
+
+        # Validate the whole batch before anything is stored
+        uploads = []
+        for file in files:
+            if not file.filename or not allowed_file(file.filename):
+                statsd_client.incr('endpoint.user.gallery.upload.error.invalid_extension')
+                return '', 400
+            content_hash, head = upload_digest(file)
+            mimetype = sniff_image_type(head)
+            if not mimetype:
+                statsd_client.incr('endpoint.user.gallery.upload.error.invalid_content')
+                return '', 400
+            uploads.append((file, content_hash, mimetype))
+
+        new_blobs = []
+        try:
+            user_id = auth.current_user().id
+            new_blobs = store_uploads(uploads, 'endpoint.user.gallery.upload')
+
+            uploaded_at = datetime.utcnow()
+            images = [Image(
+                id=str(uuid.uuid4()),
+                file_name=secure_filename(file.filename),
+                url=storage.url(blob_key(content_hash)),
+                upload_date=uploaded_at,
+                user_id=user_id,
+                content_hash=content_hash,
+                is_profile=False
+            ) for file, content_hash, mimetype in uploads]
+            db.session.add_all(images)
+            db.session.commit()
+            statsd_client.incr('endpoint.user.gallery.upload.images', len(images))
+
+            with timed_phase('serialize'):
+                body = jsonify({"images": [serialize_image(image) for image in images]})
+            return body, 201
+
+        except CircuitOpenError as e:
+            statsd_client.incr('endpoint.user.gallery.upload.error.circuit_open')
+            db.session.rollback()
+            discard_new_blobs(new_blobs)
+            return '', 503, {'Retry-After': str(retry_after_seconds(e.name))}
+
+        except Exception as e:
+            logger.error(f"Error uploading gallery images: {str(e)}")
+            statsd_client.incr('endpoint.user.gallery.upload.error')
+            db.session.rollback()
+            discard_new_blobs(new_blobs)
+            return '', 500
+
+@app.route('/v1/user/self/images', methods=['GET'])
+@auth.login_required
+@require_verification
+def list_gallery_images():
+    statsd_client.incr('endpoint.user.gallery.list.attempt')
+
+    with statsd_client.timer('endpoint.user.gallery.list.timing'):
+        if set(request.args) - {'limit', 'cursor'}:
+            statsd_client.incr('endpoint.user.gallery.list.error.query_param')
+            return '', 400
+
+        try:
+            limit = int(request.args.get('limit', app.config['GALLERY_PAGE_SIZE']))
+            cursor = request.args.get('cursor')
+            before = decode_cursor(cursor) if cursor else None
+        except (ValueError, TypeError):
+            statsd_client.incr('endpoint.user.gallery.list.error.invalid_params')
+            return '', 400
+
+        if not 0 < limit <= app.config['GALLERY_PAGE_SIZE_MAX']:
+            statsd_client.incr('endpoint.user.gallery.list.error.invalid_params')
+            return '', 400
+
+        # Newest first, walking ix_image_user_id_is_profile_upload_date_id backwards
+        query = Image.query.filter_by(user_id=auth.current_user().id, is_profile=False) \
+            .order_by(Image.upload_date.desc(), Image.id.desc())
+        if before:
+            uploaded, image_id = before
+            query = query.filter(or_(
+                Image.upload_date < uploaded,
+                and_(Image.upload_date == uploaded, Image.id < image_id)
+            ))
+        images = query.limit(limit + 1).all()
+
+        page = images[:limit]
+        next_cursor = encode_cursor(page[-1].upload_date, page[-1].id) if len(images) > limit else None
+
+        statsd_client.incr('endpoint.user.gallery.list.success')
+        with timed_phase('serialize'):
+            body = jsonify({
+                "images": [serialize_image(image) for image in page],
+                "next_cursor": next_cursor
+            })
+        return body, 200
+
+@app.route('/v1/user/self/images', methods=['DELETE'])
+@auth.login_required
+@require_verification
+def delete_gallery_images():
+    statsd_client.incr('endpoint.user.gallery.delete.attempt')
+
+    with statsd_client.timer('endpoint.user.gallery.delete.timing'):
+        if check_queryparam():
+            statsd_client.incr('endpoint.user.gallery.delete.error.query_param')
+            return '', 404
+
+        data = request.get_json(silent=True)
+        image_ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(image_ids, list) or not image_ids \
+                or len(image_ids) > app.config['GALLERY_DELETE_MAX'] \
+                or not all(isinstance(image_id, str) for image_id in image_ids):
+            statsd_client.incr('endpoint.user.gallery.delete.error.invalid_params')
+            return '', 400
+
+        try:
+            # Ids that are not this user's gallery images are ignored
+            query = Image.query.filter(
+                Image.user_id == auth.current_user().id,
+                Image.is_profile.is_(False),
+                Image.id.in_(image_ids)
+            )
+            images = query.all()
+            release_blobs(images)
+            query.delete(synchronize_session=False)
+            db.session.commit()
+
+            statsd_client.incr('endpoint.user.gallery.delete.images', len(images))
+            return '', 204
+
+        except Exception as e:
+            logger.error(f"Error deleting gallery images: {str(e)}")
+            statsd_client.incr('endpoint.user.gallery.delete.error')
+            db.session.rollback()
+            return '', 500
+
+ADMIN_EXPORT_COLUMNS = ('id', 'first_name', 'last_name', 'email', 'is_verified', 'account_created', 'account_updated')
+
+@app.route('/v1/admin/users', methods=['GET'])
+@admin_auth.login_required
+def list_users():
+    statsd_client.incr('endpoint.admin.users.list.attempt')
+
+    with statsd_client.timer('endpoint.admin.users.list.timing'):
+        if set(request.args) - {'limit', 'cursor'}:
+            statsd_client.incr('endpoint.admin.users.list.error.query_param')
+            return '', 400
+
+        try:
+            limit = int(request.args.get('limit', app.config['ADMIN_PAGE_SIZE']))
+            cursor = request.args.get('cursor')
+            after = decode_cursor(cursor) if cursor else None
+        except (ValueError, TypeError):
+            statsd_client.incr('endpoint.admin.users.list.error.invalid_params')
+            return '', 400
+
+        if not 0 < limit <= app.config['ADMIN_PAGE_SIZE_MAX']:
+            statsd_client.incr('endpoint.admin.users.list.error.invalid_params')
+            return '', 400
+
+        query = User.query.order_by(User.account_created, User.id)
+        if after:
+            # Expanded row comparison so MySQL can range-scan ix_user_account_created_id
+            created, user_id = after
+            query = query.filter(or_(
+                User.account_created > created,
+                and_(User.account_created == created, User.id > user_id)
+            ))
+        users = []
+        for _ in each_shard():
+            users.extend(query.limit(limit + 1).all())
+        users.sort(key=lambda user: (user.account_created, user.id))
+
+        page = users[:limit]
+        next_cursor = encode_cursor(page[-1].account_created, page[-1].id) if len(users) > limit else None
+
+        statsd_client.incr('endpoint.admin.users.list.success')
+        with timed_phase('serialize'):
+            body = jsonify({
+                "users": [serialize_admin_user(user) for user in page],
+                "next_cursor": next_cursor
+            })
+        return body, 200
+
+@app.route('/v1/admin/users/export', methods=['GET'])
+@admin_auth.login_required
+def export_users():
+    statsd_client.incr('endpoint.admin.users.export.attempt')
+
+    if set(request.args) - {'format'}:
+        statsd_client.incr('endpoint.admin.users.export.error.query_param')
+        return '', 400
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        statsd_client.incr('endpoint.admin.users.export.error.invalid_format')
+        return '', 400
+
+    # yield_per streams through a server-side cursor, so memory stays flat however large the table is
+    statement = select(*(getattr(User, column) for column in ADMIN_EXPORT_COLUMNS)) \
+        .order_by(User.account_created, User.id) \
+        .execution_options(yield_per=app.config['EXPORT_BATCH_SIZE'])
+
+    def export_batches():
+        # Each shard streams in (account_created, id) order, so merging keeps the export ordered
+        results = []
+        for _ in each_shard():
+            results.append(db.session.execute(statement))
+        rows = heapq.merge(*results, key=lambda row: (row.account_created, row.id))
+        while True:
+            batch = list(itertools.islice(rows, app.config['EXPORT_BATCH_SIZE']))
+            if not batch:
+                break
+            yield batch
+
+    def generate_ndjson():
+        exported = 0
+        for partition in export_batches():
+            yield ''.join(app.json.dumps(serialize_admin_user(row)) + '\n' for row in partition)
+            exported += len(partition)
+        statsd_client.incr('endpoint.admin.users.export.rows', exported)
+
+    def generate_csv():
+        exported = 0
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(ADMIN_EXPORT_COLUMNS)
+        for partition in export_batches():
+            for row in partition:
+                user = serialize_admin_user(row)
+                writer.writerow([user[column] for column in ADMIN_EXPORT_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            exported += len(partition)
+        if buffer.tell():
+            yield buffer.getvalue()
+        statsd_client.incr('endpoint.admin.users.export.rows', exported)
+
+    if export_format == 'csv':
+        generator, mimetype = generate_csv(), 'text/csv'
+    else:
+        generator, mimetype = generate_ndjson(), 'application/x-ndjson'
+
+    statsd_client.incr('endpoint.admin.users.export.success')
+    return app.response_class(stream_with_context(generator), mimetype=mimetype)
+
+def reap_expired_users(batch_size=None, max_batches=None):
+    batch_size = batch_size or app.config['TOKEN_REAPER_BATCH_SIZE']
+    max_batches = max_batches or app.config['TOKEN_REAPER_MAX_BATCHES']
+    deleted = 0
+
+    with statsd_client.timer('reaper.users.timing'):
+        for _ in each_shard():
+            deleted += reap_expired_users_on_shard(batch_size, max_batches)
+
+    statsd_client.incr('reaper.users.deleted', deleted)
+    if deleted:
+        logger.info(f"Reaped {deleted} unverified users with expired tokens")
+    return deleted
+
+def reap_expired_users_on_shard(batch_size, max_batches):
+    deleted = 0
+    for _ in range(max_batches):
+        expired_ids = [row.id for row in db.session.query(User.id).filter(
+            User.is_verified.is_(False),
+            User.token_expiry < datetime.utcnow()
+        ).limit(batch_size)]
+        if not expired_ids:
+            break
+
+        User.query.filter(User.id.in_(expired_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(expired_ids)
+
+        if len(expired_ids) < batch_size:
+            break
+    return deleted
+
+def retry_delay(attempts):
+    return min(app.config['STORAGE_CLEANUP_RETRY_BASE_SECONDS'] * 2 ** (attempts - 1),
+               app.config['STORAGE_CLEANUP_RETRY_MAX_SECONDS'])
+
+def find_user_by_id(user_id):
+    # Background jobs have no email to route by, so look on each shard
+    for shard in range(shard_router.count):
+        with use_shard(shard):
+            user = db.session.get(User, user_id)
+        if user is not None:
+            g.db_shard = shard
+            return user
+    return None
+
+def process_pending_notifications(limit=100):
+    statsd_client.gauge('sns.deferred.backlog', PendingNotification.query.count())
+    if sns_client is None:
+        return 0
+
+    now = datetime.utcnow()
+    notifications = PendingNotification.query.filter(PendingNotification.next_attempt_at <= now) \
+        .order_by(PendingNotification.next_attempt_at).limit(limit).all()
+
+    delivered = 0
+    for notification in notifications:
+        user = find_user_by_id(notification.user_id)
+        if user is None or user.is_verified:
+            # Reaped or verified while queued; there is no link left to send
+            db.session.delete(notification)
+            db.session.commit()
+            statsd_client.incr('sns.deferred.dropped')
+            continue
+        # The token sent at signup has likely expired, so the email carries a fresh one
+        token = generate_verification_token()
+        user.verification_token = hash_token(token)
+        user.token_expiry = datetime.utcnow() + timedelta(minutes=app.config['VERIFICATION_TOKEN_TTL_MINUTES'])
+        try:
+            breakers['sns'].call(sns_client.publish, TopicArn=notification.topic_arn,
+                                 Message=verification_message(user, token))
+            db.session.delete(notification)
+            delivered += 1
+        except CircuitOpenError:
+            db.session.rollback()
+            break
+        except Exception as e:
+            db.session.rollback()
+            notification.attempts += 1
+            notification.next_attempt_at = now + timedelta(seconds=retry_delay(notification.attempts))
+            logger.error(f"Deferred SNS publish failed (attempt {notification.attempts}): {str(e)}")
+        db.session.commit()
+
+    statsd_client.incr('sns.deferred.delivered', delivered)
+    return delivered
+
+def process_storage_cleanup(limit=None):
+    limit = limit or app.config['STORAGE_CLEANUP_TASKS_PER_RUN']
+    statsd_client.gauge('storage.cleanup.backlog', StorageCleanupTask.query.count())
+
+    now = datetime.utcnow()
+    tasks = StorageCleanupTask.query.filter(StorageCleanupTask.next_attempt_at <= now) \
+        .order_by(StorageCleanupTask.next_attempt_at).limit(limit).all()
+
+    completed = 0
+    for task in tasks:
+        try:
+            with statsd_client.timer('storage.cleanup.timing'):
+                if task.prefix.startswith(BLOB_PREFIX):
+                    deleted = reclaim_blob(task.prefix[len(BLOB_PREFIX):])
+                else:
+                    deleted = storage.delete_prefix(task.prefix)
+            db.session.delete(task)
+            if deleted is None:
+                statsd_client.incr('storage.cleanup.blob_still_referenced')
+            else:
+                statsd_client.incr('storage.cleanup.objects_deleted', deleted)
+                statsd_client.incr('storage.cleanup.success')
+                completed += 1
+        except Exception as e:
+            db.session.rollback()
+            task.attempts += 1
+            task.last_error = str(e)[:512]
+            task.next_attempt_at = now + timedelta(seconds=retry_delay(task.attempts))
+            statsd_client.incr('storage.cleanup.retry')
+            logger.error(f"Cleanup of {task.prefix} failed (attempt {task.attempts}): {str(e)}")
+        db.session.commit()
+    return completed
+
+def reap_idempotency_records(batch_size=1000):
+    deleted = 0
+    while True:
+        expired_keys = [row.key for row in db.session.query(IdempotencyRecord.key)
+                        .filter(IdempotencyRecord.expires_at < datetime.utcnow()).limit(batch_size)]
+        if not expired_keys:
+            break
+        IdempotencyRecord.query.filter(IdempotencyRecord.key.in_(expired_keys)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(expired_keys)
+        if len(expired_keys) < batch_size:
+            break
+    statsd_client.incr('idempotency.expired_deleted', deleted)
+    return deleted
+
+def run_periodically(name, interval, job):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    job()
+            except Exception as e:
+                logger.error(f"Background job {name} failed: {str(e)}")
+                statsd_client.incr(f'background.{name}.error')
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def start_background_jobs():
+    run_periodically('database_probe', app.config['DATABASE_PROBE_INTERVAL_SECONDS'], check_db_connection)
+    run_periodically('token_reaper', app.config['TOKEN_REAPER_INTERVAL_SECONDS'], reap_expired_users)
+    run_periodically('storage_cleanup', app.config['STORAGE_CLEANUP_INTERVAL_SECONDS'], process_storage_cleanup)
+    run_periodically('notifications', app.config['NOTIFICATION_INTERVAL_SECONDS'], process_pending_notifications)
+    run_periodically('idempotency_cleanup', app.config['IDEMPOTENCY_CLEANUP_INTERVAL_SECONDS'], reap_idempotency_records)
+    if replica_pool.engines:
+        run_periodically('replica_probe', app.config['REPLICA_PROBE_INTERVAL_SECONDS'], replica_pool.probe)
+
+@app.cli.command('reap-unverified-users')
+def reap_unverified_users_command():
+    click.echo(f"Deleted {reap_expired_users()} unverified users")
+
+def create_shard_tables():
+    for engine in shard_router.engines:
+        db.metadata.create_all(engine, tables=[User.__table__, Image.__table__])
+
+def move_user(user_id, source, target):
+    users, images = User.__table__, Image.__table__
+    with shard_router.engine(source).begin() as src:
+        user_row = src.execute(select(users).where(users.c.id == user_id)).mappings().first()
+        if user_row is None:
+            return False
+        image_rows = [dict(row) for row in src.execute(select(images).where(images.c.user_id == user_id)).mappings()]
+
+        try:
+            with shard_router.engine(target).begin() as dst:
+                dst.execute(insert(users), [dict(user_row)])
+                if image_rows:
+                    dst.execute(insert(images), image_rows)
+        except exc.IntegrityError:
+            # A previous run may have copied the user before failing to delete the source
+            with shard_router.engine(target).connect() as dst:
+                existing_id = dst.execute(select(users.c.id).where(users.c.email == user_row['email'])).scalar()
+            if existing_id != user_id:
+                statsd_client.incr('database.shard.rebalance.conflict')
+                logger.warning(f"Not moving user {user_id} to shard {target}: email already used by {existing_id}")
+                return False
+
+        src.execute(delete(images).where(images.c.user_id == user_id))
+        src.execute(delete(users).where(users.c.id == user_id))
+    return True
+
+def rebalance_shards(batch_size=500, dry_run=False):
+    # Moves users (with their images) whose email now hashes to another shard, e.g. after adding a URI
+    moved = 0
+    for source in range(shard_router.count):
+        last_id = ''
+        while True:
+            with shard_router.engine(source).connect() as conn:
+                rows = conn.execute(
+                    select(User.__table__.c.id, User.__table__.c.email)
+                    .where(User.__table__.c.id > last_id)
+                    .order_by(User.__table__.c.id)
+                    .limit(batch_size)
+                ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            for row in rows:
+                target = shard_router.shard_for_email(row.email)
+                if target == source:
+                    continue
+                if dry_run or move_user(row.id, source, target):
+                    moved += 1
+
+    statsd_client.incr('database.shard.rebalance.moved', 0 if dry_run else moved)
+    logger.info(f"Rebalance {'would move' if dry_run else 'moved'} {moved} users across {shard_router.count} shards")
+    return moved
+
+@app.cli.command('rebalance-shards')
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--dry-run', is_flag=True)
+def rebalance_shards_command(batch_size, dry_run):
+    create_shard_tables()
+    moved = rebalance_shards(batch_size, dry_run)
+    click.echo(f"{'Would move' if dry_run else 'Moved'} {moved} users")
+
+@app.errorhandler(DatabaseUnavailable)
+def handle_database_unavailable(e):
+    return '', 503, {'Retry-After': str(app.config['DEGRADED_RETRY_AFTER_SECONDS'])}
+
+@app.errorhandler(CircuitOpenError)
+def handle_circuit_open(e):
+    statsd_client.incr(f'error.circuit_open.{e.name}')
+    return '', 503, {'Retry-After': str(retry_after_seconds(e.name))}
+
 @app.errorhandler(405)
 def method_not_allowed(e):
     logger.warning(f"Method not allowed: {request.method} {request.path}")
@@ -632,10 +2476,170 @@ def add_header(response):
     return response
 
 @app.before_request
-def log_request_info():
-    logger.info(f"Request Method: {request.method}")
-    logger.info(f"Request URL: {request.url}")
-    logger.info(f"Request Headers: {dict(request.headers)}")
+def reject_when_degraded():
+    if degraded_mode.is_set() and request.endpoint not in DEGRADED_ENDPOINTS:
+        statsd_client.incr('degraded.rejected')
+        return '', 503, {'Retry-After': str(app.config['DEGRADED_RETRY_AFTER_SECONDS'])}
+
+@app.before_request
+def route_reads():
+    username = request.authorization.username if request.authorization else None
+    g.db_use_replica = (
+        request.method in ('GET', 'HEAD')
+        and request.endpoint in REPLICA_READ_ENDPOINTS
+        and not wrote_recently(username)
+    )
+
+@app.after_request
+def track_writes(response):
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400 and request.authorization:
+        mark_recent_write(request.authorization.username)
+        # The cached snapshot is stale now; the next successful read caches a fresh one
+        user_cache.forget(request.authorization.username)
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+    g.db_query_count = 0
+    g.db_time_ms = 0.0
+    g.phase_timings = {}
+
+@app.after_request
+def log_request_info(response):
+    total_ms = (time.perf_counter() - g.get('request_start_time', time.perf_counter())) * 1000
+    query_count = g.get('db_query_count', 0)
+    phases = dict(g.get('phase_timings', {}))
+    phases['db'] = g.get('db_time_ms', 0.0)
+
+    metric_prefix = f"request.{request.endpoint or 'unknown'}"
+    statsd_client.timing(f'{metric_prefix}.db.queries', query_count)
+    for phase, duration_ms in phases.items():
+        statsd_client.timing(f'{metric_prefix}.{phase}.timing', duration_ms)
+
+    server_timing = [f'total;dur={total_ms:.2f}']
+    for phase, duration_ms in phases.items():
+        entry = f'{phase};dur={duration_ms:.2f}'
+        if phase == 'db':
+            entry += f';desc="{query_count} queries"'
+        server_timing.append(entry)
+    response.headers['Server-Timing'] = ', '.join(server_timing)
+
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total_ms, 2),
+        'db_queries': query_count,
+        'phases_ms': {phase: round(duration_ms, 2) for phase, duration_ms in phases.items()}
+    }))
+
+    if metrics is not None:
+        metrics.observe_request(request.method, request.endpoint or 'unknown', response.status_code, total_ms / 1000)
+        metrics.observe_pool(db.engine.pool)
+    return response
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+
+# Preferred first when the client weights them equally
+SUPPORTED_ENCODINGS = [encoding for encoding, module in (('zstd', zstandard), ('br', brotli), ('gzip', gzip))
+                       if module is not None]
+
+def compress_body(body, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+class StreamCompressor:
+    # Flushes after every chunk so streamed exports still reach the client batch by batch
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=5)
+        else:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.encoding == 'zstd':
+            return self.compressor.compress(chunk) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+def compress_stream(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+class CompressedBodyCache:
+    # Repeated bodies (the same user or picture fetched again) reuse their compressed form
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, body, encoding):
+        if len(body) > app.config['COMPRESSION_CACHE_MAX_BODY_BYTES']:
+            # Never cached, so hashing it would be wasted work
+            return compress_body(body, encoding)
+
+        key = (hashlib.sha256(body).digest(), encoding)
+        with self.lock:
+            compressed = self.entries.get(key)
+            if compressed is not None:
+                self.entries.move_to_end(key)
+                statsd_client.incr('response.compression.cache_hit')
+                return compressed
+
+        compressed = compress_body(body, encoding)
+        with self.lock:
+            self.entries[key] = compressed
+            while len(self.entries) > app.config['COMPRESSION_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+        return compressed
+
+compressed_body_cache = CompressedBodyCache()
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code in (204, 206, 304) or request.method == 'HEAD' or 'Content-Encoding' in response.headers:
+        return response
+
+    encoding = request.accept_encodings.best_match(SUPPORTED_ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < app.config['COMPRESSION_MIN_BYTES']:
+            return response
+        with timed_phase('compress'):
+            response.set_data(compressed_body_cache.get(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    statsd_client.incr(f'response.compression.{encoding}')
+    return response
 
 @app.errorhandler(Exception)
 def handle_exception(e):
@@ -669,6 +2673,7 @@ if __name__ == '__main__':
         try:
             with statsd_client.timer('application.database.tables.creation.timing'):
                 db.create_all()
+                create_shard_tables()
             statsd_client.incr('application.database.tables.creation.success')
             logger.info("Database tables created successfully")
         except Exception as e:
@@ -676,6 +2681,10 @@ if __name__ == '__main__':
             logger.error(f"Failed to create database tables: {e}")
             exit(1)
     
+    with app.app_context():
+        warm_email_filter()
+    start_background_jobs()
+
     # Start the application
     statsd_client.incr('application.startup.success')
     app.run(host=os.getenv('HOSTNAME'))
\ No newline at end of file